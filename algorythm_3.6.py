@@ -1,14 +1,29 @@
 import asyncio
 import aiohttp
-import pandas as pd
 import numpy as np
 import math
 import json
-from datetime import datetime, timedelta
-from aiohttp import ClientSession
-import nest_asyncio
-nest_asyncio.apply()
-
+import os
+import re
+import mmap
+import struct
+import time
+import sqlite3
+import contextlib
+import contextvars
+import logging
+import heapq
+import itertools
+from bisect import bisect_left
+from collections import OrderedDict
+from types import MappingProxyType
+from urllib.parse import urlsplit
+from datetime import datetime, date as date_cls, timedelta
+from aiohttp import ClientSession, web
+try:
+    import fcntl
+except ImportError:  # Windows: блокировка обновления снимка не поддерживается
+    fcntl = None
 
 # Функция минимального времени на пересадку (рассчитывается в зависимости от типов транспорта)
 def get_required_wait(transport1, transport2):
@@ -38,12 +53,65 @@ API_KEY = "08daef05-7d15-43e0-8ad6-4b39d42e1ac0"
 SEARCH_URL = "https://api.rasp.yandex.net/v3.0/search/"
 STATIONS_URL = "https://api.rasp.yandex.net/v3.0/stations_list/"
 
-# Глобальные объекты для кэширования
-_CACHED_CITY_CODES = None
-routes_cache = {}
+# Локальный снимок списка станций
+STATIONS_SNAPSHOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stations_snapshot.bin")
+STATIONS_SNAPSHOT_MAX_AGE = 24 * 60 * 60        # после этого срока снимок обновляется в фоне
+STATIONS_SNAPSHOT_RELOAD_CHECK_INTERVAL = 60    # как часто проверять, не обновил ли снимок другой процесс
+STATIONS_RETRY_INTERVAL = 30                    # через сколько секунд повторить неудачную загрузку списка станций
 
-# Список городов для пересадки (если прямой рейс не найден)
-candidate_transfer_list = [
+# Параметры кэша ответов поиска
+ROUTES_CACHE_MAX_ENTRIES = 4096          # размер LRU в памяти процесса
+ROUTES_CACHE_DB_PATH = None              # путь к SQLite-файлу (None — кэш только в памяти)
+ROUTES_CACHE_DB_MAX_ENTRIES = 200000     # максимальное число записей в SQLite
+ROUTES_CACHE_DB_TIMEOUT = 0.05           # сколько секунд ждать блокировку SQLite (занятая база пропускается)
+# TTL (в секундах) в зависимости от того, на сколько дней вперёд выполняется поиск:
+# расписание на ближайшие дни меняется чаще, чем на дальние даты
+ROUTES_CACHE_TTL_BY_HORIZON = [
+    (0, 10 * 60),          # сегодня и прошедшие даты
+    (3, 30 * 60),          # ближайшие 3 дня
+    (30, 6 * 60 * 60),     # ближайший месяц
+]
+ROUTES_CACHE_TTL_DEFAULT = 24 * 60 * 60
+
+# Ограничения нагрузки на API
+UPSTREAM_MAX_CONCURRENCY = 32            # одновременных запросов всего
+UPSTREAM_MAX_CONCURRENCY_PER_HOST = 16   # одновременных запросов к одному хосту
+UPSTREAM_MAX_RPS = 40                    # запросов в секунду (None — без ограничения)
+
+# Пул соединений с API (одна ClientSession на процесс)
+UPSTREAM_KEEPALIVE_TIMEOUT = 60          # сколько секунд держать простаивающее соединение
+UPSTREAM_DNS_CACHE_TTL = 300             # время жизни записей DNS-кэша в секундах
+
+# Повтор запроса к API при ответах 429 и 5xx
+UPSTREAM_RETRIES = 1
+UPSTREAM_RETRY_BACKOFF = 0.5             # секунд перед первым повтором, далее вдвое больше
+UPSTREAM_RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+# Сбор метрик (счётчики, гистограммы и интервалы поиска). При выключенном сборе
+# остаётся только признак неполного результата поиска (SearchResult.partial).
+METRICS_ENABLED = False
+
+# Сколько дней, начиная с дня прибытия в город пересадки, рассматривается для второго этапа
+CONNECTION_WINDOW_DAYS = 2
+
+# HTTP-сервис поиска (python algorythm_3.6.py serve)
+SERVICE_HOST = "0.0.0.0"
+SERVICE_PORT = 8080
+SERVICE_WORKERS = 1                      # число процессов-обработчиков на одном порту
+SERVICE_MAX_TOP_N = 10
+SERVICE_MAX_BATCH = 50                   # максимальное число запросов в /api/routes/batch
+SERVICE_SEARCH_DEADLINE = 20             # ограничение времени одного поиска в секундах
+
+# Ограничение времени поиска (в секундах): по истечении возвращаются лучшие найденные
+# к этому моменту варианты. None — ждать все запросы.
+SEARCH_DEADLINE = None
+
+# Кэш Парето-фронтов маршрутов (повторные запросы с другой сортировкой или фильтрами
+# отвечаются из памяти); время жизни записи — как у кэша ответов поиска
+FRONTIER_CACHE_MAX_ENTRIES = 512
+
+# Список городов для пересадки по умолчанию (если файл TRANSFER_HUBS_PATH не найден)
+DEFAULT_TRANSFER_HUBS = [
     "Москва", "Санкт-Петербург", "Нижний Новгород", "Воронеж", "Петрозаводск", "Мурманск",
     "Архангельск", "Казань", "Самара", "Уфа", "Саратов", "Ростов-на-Дону", "Краснодар",
     "Минеральные Воды", "Волгоград", "Екатеринбург", "Челябинск", "Пермь", "Тюмень",
@@ -51,19 +119,796 @@ candidate_transfer_list = [
     "Владивосток", "Якутск", "Чита", "Магадан"
 ]
 
+# Файл со списком городов для пересадки (JSON-массив названий)
+TRANSFER_HUBS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "transfer_hubs.json")
+# Отбор городов пересадки по географии: из городов, для которых крюк
+# (dist(dep, hub) + dist(hub, arr)) / dist(dep, arr) не больше TRANSFER_HUBS_MAX_DETOUR,
+# берутся TRANSFER_HUBS_TOP_K лучших (но не меньше TRANSFER_HUBS_MIN_K, даже если крюк больше)
+TRANSFER_HUBS_TOP_K = 8
+TRANSFER_HUBS_MIN_K = 3
+TRANSFER_HUBS_MAX_DETOUR = 1.6
+TRANSFER_HUBS_MIN_DISTANCE_KM = 50.0     # для близких городов отношение не показательно
+
+def load_candidate_transfer_list(path=TRANSFER_HUBS_PATH):
+    try:
+        with open(path, encoding="utf-8") as f:
+            hubs = json.load(f)
+    except (OSError, ValueError):
+        return list(DEFAULT_TRANSFER_HUBS)
+    return [str(city) for city in hubs if str(city).strip()]
+
+# Список городов для пересадки (если прямой рейс не найден)
+candidate_transfer_list = load_candidate_transfer_list()
+
+# ================= Компактное представление сегментов =================
+# Сегмент из ответа /search/ хранится в виде объекта со слотами: времена — целые минуты
+# от 1970-01-01 (время местное, как в исходных данных), тип транспорта — небольшое целое,
+# номер и uid нитки, коды станций, минимальная цена билета (если есть в tickets_info).
+# Из исходного JSON сегмента сохраняются только поля, нужные для вывода маршрута
+# (названия станций и нитки, перевозчик, цены мест), — в кэше и в SQLite хранятся они,
+# а не весь ответ API. В словарь они превращаются только для итоговых маршрутов
+# (materialize_route).
+
+TRANSPORT_TYPES = ("train", "plane", "bus")
+TRANSPORT_OTHER = len(TRANSPORT_TYPES)    # код для прочих типов транспорта
+_TRANSPORT_CODES = {name: code for code, name in enumerate(TRANSPORT_TYPES)}
+
+def transport_code(transport):
+    return _TRANSPORT_CODES.get((transport or "").lower(), TRANSPORT_OTHER)
+
+def transport_name(code):
+    return TRANSPORT_TYPES[code] if code < TRANSPORT_OTHER else "other"
+
+def parse_ticket_price(seg):
+    # Минимальная цена среди мест из tickets_info (None, если цен нет)
+    prices = []
+    for place in ((seg.get("tickets_info") or {}).get("places") or []):
+        price = place.get("price") or {}
+        try:
+            prices.append(float(price.get("whole", 0)) + float(price.get("cents", 0)) / 100.0)
+        except (TypeError, ValueError):
+            continue
+    return min(prices) if prices else None
+
+def compact_segment_json(seg):
+    # Поля сегмента, которые используют format_route и ответы HTTP-сервиса
+    thread = seg.get("thread") or {}
+    carrier = thread.get("carrier") or {}
+    station_from = seg.get("from") or {}
+    station_to = seg.get("to") or {}
+    places = ((seg.get("tickets_info") or {}).get("places") or [])
+    compact = {
+        "thread": {
+            "number": thread.get("number"),
+            "title": thread.get("title"),
+            "transport_type": thread.get("transport_type"),
+            "uid": thread.get("uid"),
+            "carrier": {"title": carrier.get("title")},
+        },
+        "from": {"code": station_from.get("code"), "title": station_from.get("title")},
+        "to": {"code": station_to.get("code"), "title": station_to.get("title")},
+        "departure": seg.get("departure"),
+        "arrival": seg.get("arrival"),
+    }
+    if places:
+        compact["tickets_info"] = {"places": [{"currency": place.get("currency"), "price": place.get("price")}
+                                              for place in places if isinstance(place, dict)]}
+    return json.dumps(compact, ensure_ascii=False, separators=(",", ":"))
+
+# Минимальное время пересадки в минутах: строка — тип прибывшего рейса, столбец — тип следующего
+REQUIRED_WAIT_MINUTES = np.array(
+    [[get_required_wait(t1, t2) // timedelta(minutes=1) for t2 in TRANSPORT_TYPES + ("",)]
+     for t1 in TRANSPORT_TYPES + ("",)],
+    dtype=np.int64
+)
+
+_EPOCH = datetime(1970, 1, 1)
+
+def datetime_to_minutes(value):
+    return (value - _EPOCH) // timedelta(minutes=1)
+
+def minutes_to_datetime(minutes):
+    return _EPOCH + timedelta(minutes=int(minutes))
+
+class Segment:
+    __slots__ = ("departure_min", "arrival_min", "transport", "number", "uid",
+                 "from_station", "to_station", "raw_json", "price")
+
+    # Поля, доступные как у словаря маршрута из async_get_routes: route["departure"] и т. п.
+    _ROUTE_KEYS = frozenset(("departure", "arrival", "total_duration", "raw"))
+
+    def __init__(self, departure_min, arrival_min, transport, number, uid,
+                 from_station, to_station, raw_json, price=None):
+        self.departure_min = departure_min
+        self.arrival_min = arrival_min
+        self.transport = transport
+        self.number = number
+        self.uid = uid
+        self.from_station = from_station
+        self.to_station = to_station
+        self.raw_json = raw_json
+        self.price = price
+
+    @classmethod
+    def from_api(cls, seg):
+        dep_str = seg.get("departure")
+        arr_str = seg.get("arrival")
+        if not dep_str or not arr_str:
+            return None
+        try:
+            dep_time = datetime.fromisoformat(dep_str).replace(tzinfo=None)
+            arr_time = datetime.fromisoformat(arr_str).replace(tzinfo=None)
+        except Exception:
+            return None
+        if (arr_time - dep_time).total_seconds() <= 0:
+            return None
+        thread = seg.get("thread") or {}
+        return cls(
+            datetime_to_minutes(dep_time),
+            datetime_to_minutes(arr_time),
+            transport_code(thread.get("transport_type")),
+            thread.get("number"),
+            thread.get("uid"),
+            (seg.get("from") or {}).get("code"),
+            (seg.get("to") or {}).get("code"),
+            compact_segment_json(seg),
+            parse_ticket_price(seg)
+        )
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(*row)
+
+    def to_row(self):
+        return [self.departure_min, self.arrival_min, self.transport, self.number, self.uid,
+                self.from_station, self.to_station, self.raw_json, self.price]
+
+    @property
+    def departure(self):
+        return minutes_to_datetime(self.departure_min)
+
+    @property
+    def arrival(self):
+        return minutes_to_datetime(self.arrival_min)
+
+    @property
+    def total_duration(self):
+        return float(self.arrival_min - self.departure_min)
+
+    @property
+    def raw(self):
+        return json.loads(self.raw_json)
+
+    def __getitem__(self, key):
+        if key not in self._ROUTE_KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self._ROUTE_KEYS
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self._ROUTE_KEYS else default
+
+    def to_route(self):
+        return {
+            "departure": self.departure,
+            "arrival": self.arrival,
+            "total_duration": self.total_duration,
+            "raw": self.raw
+        }
+
+def materialize_route(route):
+    # Заменяет компактные сегменты в итоговом маршруте словарями с исходными данными API
+    if isinstance(route, Segment):
+        return route.to_route()
+    result = dict(route)
+    segment = result.pop("segment", None)
+    if segment is not None:
+        result["raw"] = segment.raw
+    for key in ("first_leg", "second_leg"):
+        if key in result:
+            result[key] = materialize_route(result[key])
+    if "first_leg" in result and isinstance(result.get("raw"), dict) and "seg1" in result["raw"]:
+        result["raw"] = {"seg1": result["first_leg"], "seg2": result["second_leg"]}
+    if "legs" in result:
+        result["legs"] = [materialize_route(leg) for leg in result["legs"]]
+    return result
+
+# Разбор ответа /search/ по одному сегменту: строка ответа не превращается в дерево
+# объектов целиком, в памяти одновременно находится только текущий сегмент.
+_JSON_DECODER = json.JSONDecoder()
+_JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+def iter_json_array_items(text, key):
+    # Выдаёт элементы массива text[key] объекта верхнего уровня по одному
+    skip = _JSON_WHITESPACE.match
+    decode = _JSON_DECODER.raw_decode
+    pos = skip(text, 0).end()
+    if not text.startswith("{", pos):
+        raise ValueError("ожидался JSON-объект")
+    pos = skip(text, pos + 1).end()
+    while not text.startswith("}", pos):
+        name, pos = decode(text, pos)
+        pos = skip(text, pos).end()
+        if not text.startswith(":", pos):
+            raise ValueError("ожидалось ':'")
+        pos = skip(text, pos + 1).end()
+        if name == key and text.startswith("[", pos):
+            pos = skip(text, pos + 1).end()
+            while not text.startswith("]", pos):
+                item, pos = decode(text, pos)
+                yield item
+                pos = skip(text, pos).end()
+                if text.startswith(",", pos):
+                    pos = skip(text, pos + 1).end()
+                elif not text.startswith("]", pos):
+                    raise ValueError("ожидалось ',' или ']'")
+            pos += 1
+        else:
+            _, pos = decode(text, pos)
+        pos = skip(text, pos).end()
+        if text.startswith(",", pos):
+            pos = skip(text, pos + 1).end()
+        elif not text.startswith("}", pos):
+            raise ValueError("ожидалось ',' или '}'")
+
+def parse_search_segments(text):
+    segments = []
+    for seg in iter_json_array_items(text, "segments"):
+        if isinstance(seg, dict):
+            segment = Segment.from_api(seg)
+            if segment is not None:
+                segments.append(segment)
+    return segments
+
+# ================= Кэш ответов поиска =================
+# Ключ кэша — нормализованные параметры запроса (from, to, date, min_dep_time).
+# Значение — список сегментов (Segment) из ответа /search/. Записи хранятся в LRU в памяти
+# процесса и, если задан путь к базе, дублируются в SQLite, чтобы переживать перезапуск.
+
+def normalize_search_date(date):
+    if isinstance(date, datetime):
+        return date.strftime("%Y-%m-%d")
+    if isinstance(date, date_cls):
+        return date.isoformat()
+    return str(date).strip()[:10]
+
+def make_routes_cache_key(from_code, to_code, date, min_departure_time=None):
+    min_dep = min_departure_time.strftime("%Y-%m-%dT%H:%M") if min_departure_time else ""
+    return (from_code.strip(), to_code.strip(), normalize_search_date(date), min_dep)
+
+def get_cache_ttl(date):
+    try:
+        search_date = datetime.strptime(normalize_search_date(date), "%Y-%m-%d").date()
+    except ValueError:
+        return ROUTES_CACHE_TTL_BY_HORIZON[0][1]
+    days_ahead = (search_date - date_cls.today()).days
+    for max_days, ttl in ROUTES_CACHE_TTL_BY_HORIZON:
+        if days_ahead <= max_days:
+            return ttl
+    return ROUTES_CACHE_TTL_DEFAULT
+
+class RoutesCache:
+    def __init__(self, max_entries=ROUTES_CACHE_MAX_ENTRIES, db_path=None,
+                 db_max_entries=ROUTES_CACHE_DB_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.db_path = db_path
+        self.db_max_entries = db_max_entries
+        self._entries = OrderedDict()
+        self._db = None
+        self._db_writes = 0
+        if db_path:
+            try:
+                self._open_db(db_path)
+            except sqlite3.Error:
+                self._db_failed("открытие")
+                self.close()
+
+    # Версия формата записей в SQLite; при несовпадении таблица пересоздаётся
+    DB_SCHEMA_VERSION = 4
+
+    def _open_db(self, db_path):
+        # Короткий timeout: база общая для процессов сервиса, и ожидание чужой записи
+        # не должно останавливать цикл событий
+        self._db = sqlite3.connect(db_path, timeout=ROUTES_CACHE_DB_TIMEOUT, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        if self._db.execute("PRAGMA user_version").fetchone()[0] != self.DB_SCHEMA_VERSION:
+            self._db.execute("DROP TABLE IF EXISTS routes")
+            self._db.execute(f"PRAGMA user_version = {self.DB_SCHEMA_VERSION}")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS routes ("
+            "key TEXT PRIMARY KEY, expires_at REAL NOT NULL, "
+            "stored_at REAL NOT NULL, payload TEXT NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS routes_stored_at ON routes (stored_at)")
+        self._db.commit()
+
+    @staticmethod
+    def _db_key(key):
+        return "|".join(key)
+
+    @staticmethod
+    def _encode(segments):
+        return json.dumps([segment.to_row() for segment in segments], ensure_ascii=False)
+
+    @staticmethod
+    def _decode(payload):
+        return [Segment.from_row(row) for row in json.loads(payload)]
+
+    def _db_failed(self, action):
+        # Ошибка SQLite (например, база заблокирована другим процессом) не прерывает поиск:
+        # запись остаётся только в LRU в памяти
+        logging.getLogger(__name__).warning("кэш маршрутов в SQLite недоступен (%s)", action, exc_info=True)
+        if self._db is not None:
+            with contextlib.suppress(sqlite3.Error):
+                self._db.rollback()
+
+    def _remember(self, key, value, expires_at):
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, key):
+        now = time.time()
+        item = self._entries.get(key)
+        if item is not None:
+            expires_at, value = item
+            if expires_at > now:
+                self._entries.move_to_end(key)
+                return value
+            del self._entries[key]
+        if self._db is not None:
+            try:
+                row = self._db.execute(
+                    "SELECT expires_at, payload FROM routes WHERE key = ?", (self._db_key(key),)
+                ).fetchone()
+            except sqlite3.Error:
+                self._db_failed("чтение")
+                return None
+            if row is not None and row[0] > now:
+                value = self._decode(row[1])
+                self._remember(key, value, row[0])
+                return value
+        return None
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        expires_at = now + ttl
+        self._remember(key, value, expires_at)
+        if self._db is not None:
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO routes (key, expires_at, stored_at, payload) VALUES (?, ?, ?, ?)",
+                    (self._db_key(key), expires_at, now, self._encode(value))
+                )
+                self._db.commit()
+                self._db_writes += 1
+                if self._db_writes % 256 == 0:
+                    self._evict_db(now)
+            except sqlite3.Error:
+                self._db_failed("запись")
+
+    def _evict_db(self, now):
+        # Сначала удаляем просроченные записи, затем самые старые сверх лимита
+        self._db.execute("DELETE FROM routes WHERE expires_at <= ?", (now,))
+        count = self._db.execute("SELECT COUNT(*) FROM routes").fetchone()[0]
+        if count > self.db_max_entries:
+            self._db.execute(
+                "DELETE FROM routes WHERE key IN "
+                "(SELECT key FROM routes ORDER BY stored_at LIMIT ?)",
+                (count - self.db_max_entries,)
+            )
+        self._db.commit()
+
+    def items(self):
+        # Все непросроченные записи: сначала из памяти, затем из SQLite
+        now = time.time()
+        seen = set()
+        for key, (expires_at, value) in list(self._entries.items()):
+            if expires_at > now:
+                seen.add(key)
+                yield key, value
+        if self._db is not None:
+            try:
+                rows = self._db.execute("SELECT key, payload FROM routes WHERE expires_at > ?", (now,)).fetchall()
+            except sqlite3.Error:
+                self._db_failed("чтение")
+                rows = []
+            for db_key, payload in rows:
+                key = tuple(db_key.split("|"))
+                if key not in seen:
+                    yield key, self._decode(payload)
+
+    def clear(self):
+        self._entries.clear()
+        if self._db is not None:
+            try:
+                self._db.execute("DELETE FROM routes")
+                self._db.commit()
+            except sqlite3.Error:
+                self._db_failed("очистка")
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+def configure_routes_cache(max_entries=ROUTES_CACHE_MAX_ENTRIES, db_path=ROUTES_CACHE_DB_PATH,
+                           db_max_entries=ROUTES_CACHE_DB_MAX_ENTRIES):
+    global routes_cache
+    routes_cache.close()
+    routes_cache = RoutesCache(max_entries, db_path, db_max_entries)
+    return routes_cache
+
+# Глобальные объекты для кэширования
+_CACHED_CITY_CODES = None
+_CITY_INDEX = None
+_CITY_INDEX_RETRY_AT = 0.0
+routes_cache = RoutesCache(ROUTES_CACHE_MAX_ENTRIES, ROUTES_CACHE_DB_PATH, ROUTES_CACHE_DB_MAX_ENTRIES)
+
+# ================= Ограничение параллелизма и объединение запросов =================
+# Семафоры и очередь запросов привязаны к циклу событий, поэтому состояние создаётся
+# отдельно для каждого цикла. Одинаковые запросы, выполняемые одновременно,
+# объединяются: первый создаёт задачу, остальные ждут её результата.
+
+class UpstreamLimiter:
+    def __init__(self, max_concurrency=UPSTREAM_MAX_CONCURRENCY,
+                 max_concurrency_per_host=UPSTREAM_MAX_CONCURRENCY_PER_HOST,
+                 max_rps=UPSTREAM_MAX_RPS):
+        self.max_concurrency_per_host = max_concurrency_per_host
+        self.max_rps = max_rps
+        self._global = asyncio.Semaphore(max_concurrency)
+        self._per_host = {}
+        self._next_slot = 0.0
+        self.inflight = {}
+
+    def _host_semaphore(self, host):
+        semaphore = self._per_host.get(host)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.max_concurrency_per_host)
+            self._per_host[host] = semaphore
+        return semaphore
+
+    async def _wait_rate(self):
+        if not self.max_rps:
+            return
+        # Слот не резервируется заранее, поэтому отменённые запросы не задерживают остальные
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if now >= self._next_slot:
+                self._next_slot = now + 1.0 / self.max_rps
+                return
+            await asyncio.sleep(self._next_slot - now)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, url):
+        async with self._host_semaphore(urlsplit(url).netloc):
+            async with self._global:
+                await self._wait_rate()
+                yield
+
+_UPSTREAM_LIMITER = None
+
+def get_upstream_limiter():
+    global _UPSTREAM_LIMITER
+    loop = asyncio.get_running_loop()
+    if _UPSTREAM_LIMITER is None or _UPSTREAM_LIMITER[0] is not loop:
+        # Ограничения читаются при создании, чтобы действовали значения из configure_upstream_limits
+        _UPSTREAM_LIMITER = (loop, UpstreamLimiter(UPSTREAM_MAX_CONCURRENCY, UPSTREAM_MAX_CONCURRENCY_PER_HOST,
+                                                   UPSTREAM_MAX_RPS))
+    return _UPSTREAM_LIMITER[1]
+
+def configure_upstream_limits(max_concurrency=UPSTREAM_MAX_CONCURRENCY,
+                              max_concurrency_per_host=UPSTREAM_MAX_CONCURRENCY_PER_HOST,
+                              max_rps=UPSTREAM_MAX_RPS):
+    global UPSTREAM_MAX_CONCURRENCY, UPSTREAM_MAX_CONCURRENCY_PER_HOST, UPSTREAM_MAX_RPS, _UPSTREAM_LIMITER
+    UPSTREAM_MAX_CONCURRENCY = max_concurrency
+    UPSTREAM_MAX_CONCURRENCY_PER_HOST = max_concurrency_per_host
+    UPSTREAM_MAX_RPS = max_rps
+    _UPSTREAM_LIMITER = None
+
+# ================= Инструментирование =================
+# Каждый поиск получает объект SearchTrace, доступный через contextvars во всех задачах
+# поиска. В нём отмечается, что результат неполный (таймаут или ошибка API, истёкший
+# deadline), и при METRICS_ENABLED — интервалы этапов (перебор городов пересадки, запросы
+# первого и второго плеча, разбор, стыковка, сортировка) и счётчики запросов.
+# Глобальные счётчики и гистограммы хранятся в metrics и выводятся в текстовом формате
+# Prometheus (render_prometheus); завершённые поиски передаются подключённым приёмникам
+# (add_metrics_sink), например LoggingMetricsSink для структурированных логов.
+
+UPSTREAM_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0)
+SEARCH_DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class MetricsRegistry:
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [buckets, [0] * len(buckets), 0.0, 0]
+        bucket_counts = histogram[1]
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                bucket_counts[i] += 1
+        histogram[2] += value
+        histogram[3] += 1
+
+    def clear(self):
+        self.counters.clear()
+        self.histograms.clear()
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ""
+        return "{" + ",".join(f'{name}="{value}"' for name, value in items) + "}"
+
+    def render_prometheus(self):
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), (buckets, bucket_counts, total, count) in sorted(self.histograms.items()):
+            for bound, bucket_count in zip(buckets, bucket_counts):
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {bucket_count}")
+            lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total}")
+            lines.append(f"{name}_count{self._labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+def render_prometheus():
+    return metrics.render_prometheus()
+
+_METRICS_SINKS = []
+
+def add_metrics_sink(sink):
+    # sink — вызываемый объект, получающий словарь с описанием завершённого поиска
+    _METRICS_SINKS.append(sink)
+
+def remove_metrics_sink(sink):
+    if sink in _METRICS_SINKS:
+        _METRICS_SINKS.remove(sink)
+
+class LoggingMetricsSink:
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger("rasp.search")
+        self.level = level
+
+    def __call__(self, event):
+        self.logger.log(self.level, json.dumps(event, ensure_ascii=False, default=str))
+
+_NULL_SPAN = contextlib.nullcontext()
+
+class SearchTrace:
+    __slots__ = ("name", "started", "duration", "partial", "counters", "spans")
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.duration = None
+        self.partial = False
+        self.counters = {}
+        self.spans = []
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def span(self, name):
+        if not METRICS_ENABLED:
+            return _NULL_SPAN
+        return self._span(name)
+
+    @contextlib.contextmanager
+    def _span(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans.append((name, started - self.started, time.perf_counter() - started))
+
+    def to_dict(self):
+        return {
+            "search": self.name,
+            "duration_ms": round((self.duration or 0.0) * 1000.0, 3),
+            "partial": self.partial,
+            "counters": dict(self.counters),
+            "spans": [{"name": name, "start_ms": round(start * 1000.0, 3), "duration_ms": round(duration * 1000.0, 3)}
+                      for name, start, duration in self.spans],
+        }
+
+_CURRENT_TRACE = contextvars.ContextVar("search_trace", default=None)
+
+def current_trace():
+    return _CURRENT_TRACE.get()
+
+def mark_partial(reason):
+    trace = _CURRENT_TRACE.get()
+    if trace is not None:
+        trace.partial = True
+        trace.count(reason)
+
+@contextlib.contextmanager
+def search_trace(name):
+    # Вложенный поиск (например, этап комбинированного маршрута) пишет в трассу внешнего
+    trace = _CURRENT_TRACE.get()
+    if trace is not None:
+        with trace.span(name):
+            yield trace
+        return
+    trace = SearchTrace(name)
+    token = _CURRENT_TRACE.set(trace)
+    try:
+        yield trace
+    finally:
+        _CURRENT_TRACE.reset(token)
+        trace.duration = time.perf_counter() - trace.started
+        if METRICS_ENABLED:
+            metrics.inc("rasp_searches_total", search=name, partial=str(trace.partial).lower())
+            metrics.observe("rasp_search_duration_seconds", trace.duration, SEARCH_DURATION_BUCKETS, search=name)
+            if _METRICS_SINKS:
+                event = trace.to_dict()
+                for sink in list(_METRICS_SINKS):
+                    try:
+                        sink(event)
+                    except Exception:
+                        logging.getLogger(__name__).exception("ошибка приёмника метрик")
+
+class SearchResult(list):
+    # Список маршрутов; partial=True, если часть запросов к API не удалась или истёк deadline;
+    # error — описание ошибки, если запрос пакета не удалось разобрать
+    def __init__(self, routes=(), partial=False, trace=None, error=None):
+        super().__init__(routes)
+        self.partial = partial
+        self.trace = trace
+        self.error = error
+
+def _endpoint_name(url):
+    return urlsplit(url).path.rstrip("/").rsplit("/", 1)[-1] or "unknown"
+
+def _record_upstream(url, outcome, latency, nbytes):
+    endpoint = _endpoint_name(url)
+    metrics.inc("rasp_upstream_requests_total", endpoint=endpoint, outcome=outcome)
+    if nbytes:
+        metrics.inc("rasp_upstream_bytes_total", nbytes, endpoint=endpoint)
+    if latency is not None:
+        metrics.observe("rasp_upstream_latency_seconds", latency, UPSTREAM_LATENCY_BUCKETS, endpoint=endpoint)
+
 # ================= Асинхронные функции для получения данных =================
 
-async def fetch_json(session: ClientSession, url: str, params: dict):
+# Возвращает пару (текст ответа, признак корректного ответа). Ответ 404 считается корректным
+# (маршрутов нет), а ошибки сети и таймауты — нет: такие ответы не кэшируются.
+async def _fetch_text(session: ClientSession, url: str, params: dict):
+    for attempt in range(UPSTREAM_RETRIES + 1):
+        text, ok, outcome = await _fetch_text_once(session, url, params)
+        if outcome not in UPSTREAM_RETRY_STATUSES or attempt == UPSTREAM_RETRIES:
+            return text, ok
+        if METRICS_ENABLED:
+            metrics.inc("rasp_upstream_retries_total", endpoint=_endpoint_name(url))
+        await asyncio.sleep(UPSTREAM_RETRY_BACKOFF * 2 ** attempt)
+    return "", False
+
+# Один запрос; третий элемент — исход запроса для метрик ("ok", "not_found", "timeout",
+# "error") или код ответа, при котором запрос можно повторить
+async def _fetch_text_once(session: ClientSession, url: str, params: dict):
+    started, nbytes = None, 0
+    result = ("", False, "error")
     try:
-        async with session.get(url, params=params, timeout=20) as response:
-            if response.status == 404:
-                return {}
-            response.raise_for_status()
-            return await response.json(content_type=None)
-    except (asyncio.TimeoutError, asyncio.CancelledError):
-        return {}
+        async with get_upstream_limiter().acquire(url):
+            started = time.perf_counter()
+            async with session.get(url, params=params, timeout=20) as response:
+                if response.status == 404:
+                    result = ("", True, "not_found")
+                elif response.status in UPSTREAM_RETRY_STATUSES:
+                    result = ("", False, response.status)
+                else:
+                    response.raise_for_status()
+                    body = await response.read()
+                    nbytes = len(body)
+                    result = (body.decode("utf-8"), True, "ok")
+    except asyncio.TimeoutError:
+        result = ("", False, "timeout")
+    except asyncio.CancelledError:
+        # Отмена передаётся дальше: задача ненужного запроса должна завершиться отменённой
+        result = ("", False, "cancelled")
+        raise
     except Exception:
-        return {}
+        result = ("", False, "error")
+    finally:
+        if METRICS_ENABLED:
+            latency = time.perf_counter() - started if started is not None else None
+            outcome = result[2] if isinstance(result[2], str) else "http_error"
+            _record_upstream(url, outcome, latency, nbytes)
+    return result
+
+async def _fetch_json(session: ClientSession, url: str, params: dict):
+    text, ok = await _fetch_text(session, url, params)
+    if not text:
+        return {}, ok
+    try:
+        return json.loads(text), ok
+    except ValueError:
+        return {}, False
+
+async def fetch_json(session: ClientSession, url: str, params: dict):
+    data, _ = await _fetch_json(session, url, params)
+    return data
+
+async def async_search_segments(session, from_code, to_code, date, min_departure_time=None):
+    trace = _CURRENT_TRACE.get()
+    key = make_routes_cache_key(from_code, to_code, date, min_departure_time)
+    segments = routes_cache.get(key)
+    if segments is not None:
+        if trace is not None:
+            trace.count("cache_hits")
+        if METRICS_ENABLED:
+            metrics.inc("rasp_routes_cache_total", result="hit")
+        return segments
+    inflight = get_upstream_limiter().inflight
+    entry = inflight.get(key)
+    if entry is None:
+        # Запись: [общая задача, число ожидающих]
+        entry = [asyncio.ensure_future(_fetch_search_segments(session, key)), 0]
+        inflight[key] = entry
+        entry[0].add_done_callback(lambda _: inflight.get(key) is entry and inflight.pop(key))
+        result = "miss"
+    else:
+        result = "coalesced"
+    if trace is not None:
+        trace.count("upstream_requests" if result == "miss" else "coalesced_requests")
+    if METRICS_ENABLED:
+        metrics.inc("rasp_routes_cache_total", result=result)
+    future = entry[0]
+    entry[1] += 1
+    try:
+        # shield: отмена одного из ожидающих не должна прерывать общий запрос
+        segments, ok = await asyncio.shield(future)
+    except asyncio.CancelledError:
+        # Запрос больше никому не нужен — отменяем его, пока он не ушёл в API
+        if entry[1] == 1 and not future.done():
+            inflight.pop(key, None)
+            future.cancel()
+        raise
+    finally:
+        entry[1] -= 1
+    if not ok:
+        # Таймаут или ошибка API: пустой список здесь не означает, что рейсов нет
+        mark_partial("failed_requests")
+    return segments
+
+async def _fetch_search_segments(session, key):
+    params = {
+        "apikey": API_KEY,
+        "format": "json",
+        "from": key[0],
+        "to": key[1],
+        "date": key[2],
+        "lang": "ru_RU"
+    }
+    if key[3]:
+        params["min_dep_time"] = key[3]
+    text, ok = await _fetch_text(session, SEARCH_URL, params)
+    trace = _CURRENT_TRACE.get()
+    try:
+        with trace.span("parse") if trace is not None else _NULL_SPAN:
+            segments = parse_search_segments(text) if text else []
+    except (ValueError, IndexError):
+        segments, ok = [], False
+    if ok:
+        routes_cache.set(key, segments, get_cache_ttl(key[2]))
+    return segments, ok
 
 async def get_city_codes_async(session: ClientSession):
     global _CACHED_CITY_CODES
@@ -71,6 +916,13 @@ async def get_city_codes_async(session: ClientSession):
         return _CACHED_CITY_CODES
     params = {"apikey": API_KEY, "format": "json", "lang": "ru_RU"}
     data = await fetch_json(session, STATIONS_URL, params)
+    city_codes = parse_stations_list(data)
+    # Пустой список (API недоступен) не кэшируется
+    if city_codes:
+        _CACHED_CITY_CODES = city_codes
+    return city_codes
+
+def parse_stations_list(data):
     city_codes = []
     for country in data.get("countries", []):
         for region in country.get("regions", []):
@@ -92,193 +944,640 @@ async def get_city_codes_async(session: ClientSession):
                         "Yandex-код": city_code,
                         "coords": coords
                     })
-    _CACHED_CITY_CODES = city_codes
     return city_codes
 
 # ================= Функции для работы с городами =================
 
-def city_codes_to_dataframe(city_codes):
-    if not city_codes:
-        return None
-    return pd.DataFrame(city_codes)
+def get_city_code_by_name(city_index, city_name):
+    return city_index.get_code(city_name)
 
-def find_city_by_name(city_codes_df, city_name):
-    filtered = city_codes_df[city_codes_df["Город"].str.lower() == city_name.lower()]
-    if filtered.empty:
-        return None
-    return filtered
+# ================= Индекс городов =================
+# Строится один раз после загрузки списка станций и дальше не изменяется.
+# Поиск кода по названию и координат по коду выполняется по словарям за O(1).
+# Города хранятся отсортированными по нормализованному названию (keys), поэтому
+# автодополнение — бинарный поиск префикса в keys без дополнительных структур;
+# тот же порядок записывается в снимок и читается из него через mmap.
 
-def get_city_code_by_name(city_codes_df, city_name):
-    df_filtered = find_city_by_name(city_codes_df, city_name)
-    if df_filtered is None or df_filtered.empty:
-        return None
-    return df_filtered.iloc[0]["Yandex-код"]
+def normalize_city_name(city_name):
+    return " ".join(str(city_name).casefold().replace("ё", "е").split())
 
-def get_all_city_codes_dict(city_codes):
-    return {city["Город"]: {"code": city["Yandex-код"], "coords": city["coords"]}
-            for city in city_codes if city["Yandex-код"].startswith("c")}
+class CityIndex:
+    __slots__ = ("names", "codes", "keys", "lat", "lon", "_code_by_name", "_row_by_code", "_sorted_keys")
 
+    def __init__(self, names, codes, lat, lon, keys=None):
+        self.names = tuple(names)
+        self.codes = tuple(codes)
+        self.keys = tuple(keys) if keys is not None else tuple(normalize_city_name(name) for name in self.names)
+        self.lat = np.asarray(lat, dtype=np.float32)
+        self.lon = np.asarray(lon, dtype=np.float32)
+        self.lat.flags.writeable = False
+        self.lon.flags.writeable = False
+        # Обход в обратном порядке: при совпадении названий остаётся первый город, как при поиске по DataFrame
+        self._code_by_name = MappingProxyType(dict(zip(reversed(self.keys), reversed(self.codes))))
+        self._row_by_code = MappingProxyType(dict(zip(reversed(self.codes), range(len(self.codes) - 1, -1, -1))))
+        self._sorted_keys = None
 
-# ================= Функция получения маршрутов между станциями =================
+    def __len__(self):
+        return len(self.codes)
 
-async def async_get_routes(session, from_code, to_code, date, min_departure_time=None):
-    params = {
-        "apikey": API_KEY,
-        "format": "json",
-        "from": from_code,
-        "to": to_code,
-        "date": date,
-        "lang": "ru_RU"
+    def get_code(self, city_name):
+        if not city_name:
+            return None
+        return self._code_by_name.get(normalize_city_name(city_name))
+
+    def get_row(self, city_code):
+        return self._row_by_code.get(city_code)
+
+    def get_name(self, city_code):
+        row = self._row_by_code.get(city_code)
+        return self.names[row] if row is not None else None
+
+    def get_coords(self, city_code):
+        row = self._row_by_code.get(city_code)
+        if row is None or np.isnan(self.lat[row]) or np.isnan(self.lon[row]):
+            return None
+        return float(self.lat[row]), float(self.lon[row])
+
+    def _get_sorted_keys(self):
+        # (отсортированные ключи, номера строк или None, если keys уже отсортированы)
+        if self._sorted_keys is None:
+            keys = self.keys
+            if all(keys[i] <= keys[i + 1] for i in range(len(keys) - 1)):
+                self._sorted_keys = (keys, None)
+            else:
+                # Индекс собран не через build_city_index (например, снимок старого формата)
+                rows = sorted(range(len(keys)), key=keys.__getitem__)
+                self._sorted_keys = (tuple(keys[row] for row in rows), rows)
+        return self._sorted_keys
+
+    def suggest(self, prefix, limit=10):
+        prefix = normalize_city_name(prefix)
+        keys, rows = self._get_sorted_keys()
+        suggestions = []
+        for position in range(bisect_left(keys, prefix), len(keys)):
+            if len(suggestions) >= limit or not keys[position].startswith(prefix):
+                break
+            row = rows[position] if rows is not None else position
+            suggestions.append({"Город": self.names[row], "Yandex-код": self.codes[row]})
+        return suggestions
+
+def build_city_index(city_codes):
+    # Устойчивая сортировка: среди городов с одинаковым названием первым остаётся первый из списка
+    keyed = sorted(((normalize_city_name(city["Город"]), city) for city in city_codes), key=lambda item: item[0])
+    names, codes, lat, lon = [], [], [], []
+    for _, city in keyed:
+        names.append(city["Город"])
+        codes.append(city["Yandex-код"])
+        coords = city.get("coords")
+        lat.append(coords[0] if coords else np.nan)
+        lon.append(coords[1] if coords else np.nan)
+    return CityIndex(names, codes, lat, lon, [key for key, _ in keyed])
+
+async def get_city_index_async(session: ClientSession, snapshot_path=None):
+    # Пустой индекс (список станций не удалось получить) не запоминается: загрузка повторяется
+    # не чаще раза в STATIONS_RETRY_INTERVAL, а до тех пор возвращается пустой индекс
+    global _CITY_INDEX, _CITY_INDEX_RETRY_AT
+    if snapshot_path is None:
+        snapshot_path = STATIONS_SNAPSHOT_PATH
+    if _CITY_INDEX is None:
+        now = time.time()
+        if now < _CITY_INDEX_RETRY_AT:
+            return build_city_index([])
+        _CITY_INDEX_RETRY_AT = now + STATIONS_RETRY_INTERVAL
+        city_index = await load_city_index(session, snapshot_path)
+        if not len(city_index):
+            return city_index
+        _CITY_INDEX = city_index
+    elif snapshot_path and _reload_snapshot_if_changed(snapshot_path):
+        # В долго работающем процессе устаревший снимок обновляется так же, как при запуске
+        _schedule_snapshot_refresh(snapshot_path, _STATIONS_SNAPSHOT)
+    return _CITY_INDEX
+
+# ================= Снимок списка станций =================
+# Список станций сохраняется в компактный файл и при запуске отображается в память (mmap),
+# поэтому повторно скачивать и разбирать ответ /stations_list/ не нужно, а несколько
+# процессов-обработчиков читают одни и те же страницы файла.
+#
+# Формат файла: сигнатура SNAPSHOT_MAGIC, длина заголовка (uint32, little-endian),
+# JSON-заголовок с метаданными и смещениями секций, затем секции, выровненные по 8 байт:
+# lat и lon (float32[count]), а также столбцы names, keys, codes — строки в UTF-8,
+# разделённые переводом строки.
+
+SNAPSHOT_MAGIC = b"RASPSNP1"
+
+class StationsSnapshot:
+    __slots__ = ("path", "meta", "index", "mtime", "_mmap")
+
+    def __init__(self, path, meta, index, mtime, mapped):
+        self.path = path
+        self.meta = meta
+        self.index = index
+        self.mtime = mtime
+        self._mmap = mapped
+
+    def age(self):
+        return time.time() - self.meta.get("fetched_at", 0)
+
+def _snapshot_text_column(values):
+    return "\n".join(value.replace("\n", " ") for value in values).encode("utf-8")
+
+def write_stations_snapshot(path, city_index, etag=None, last_modified=None, fetched_at=None):
+    columns = [
+        ("lat", np.ascontiguousarray(city_index.lat, dtype="<f4").tobytes()),
+        ("lon", np.ascontiguousarray(city_index.lon, dtype="<f4").tobytes()),
+        ("names", _snapshot_text_column(city_index.names)),
+        ("keys", _snapshot_text_column(city_index.keys)),
+        ("codes", _snapshot_text_column(city_index.codes)),
+    ]
+    meta = {
+        "count": len(city_index),
+        "etag": etag,
+        "last_modified": last_modified,
+        "fetched_at": time.time() if fetched_at is None else fetched_at,
     }
-    if min_departure_time:
-        params["min_dep_time"] = min_departure_time.strftime("%Y-%m-%dT%H:%M")
+    # Смещения секций отсчитываются от конца заголовка
+    sections = {}
+    offset = 0
+    for name, payload in columns:
+        sections[name] = [offset, len(payload)]
+        offset += len(payload) + (-len(payload) % 8)
+    meta["sections"] = sections
+    header = json.dumps(meta, ensure_ascii=False).encode("utf-8")
+    header += b" " * (-(len(SNAPSHOT_MAGIC) + 4 + len(header)) % 8)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(struct.pack("<I", len(header)))
+        f.write(header)
+        for name, payload in columns:
+            f.write(payload)
+            f.write(b"\0" * (-len(payload) % 8))
+    # Замена атомарна: процессы, уже отобразившие старый файл, продолжают его читать
+    os.replace(tmp_path, path)
+    return meta
+
+def load_stations_snapshot(path):
+    with open(path, "rb") as f:
+        mtime = os.fstat(f.fileno()).st_mtime
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic_size = len(SNAPSHOT_MAGIC)
+    if mapped[:magic_size] != SNAPSHOT_MAGIC:
+        mapped.close()
+        raise ValueError(f"{path}: не является снимком списка станций")
     try:
-        async with session.get(SEARCH_URL, params=params, timeout=20) as response:
-            if response.status == 404:
-                data = {}
-            else:
+        return _parse_stations_snapshot(path, mapped, mtime)
+    except (struct.error, KeyError, TypeError, ValueError) as e:
+        # Обрезанный или повреждённый файл: вызывающий код пересоздаёт снимок
+        mapped.close()
+        raise ValueError(f"{path}: повреждённый снимок списка станций ({e})") from e
+
+def _parse_stations_snapshot(path, mapped, mtime):
+    magic_size = len(SNAPSHOT_MAGIC)
+    (header_size,) = struct.unpack_from("<I", mapped, magic_size)
+    base = magic_size + 4 + header_size
+    if base > len(mapped):
+        raise ValueError("заголовок выходит за границы файла")
+    meta = json.loads(mapped[magic_size + 4:base].decode("utf-8"))
+    count = meta["count"]
+    sections = meta["sections"]
+    for name, (offset, size) in sections.items():
+        if offset < 0 or size < 0 or base + offset + size > len(mapped):
+            raise ValueError(f"секция {name} выходит за границы файла")
+
+    def array_column(name):
+        offset, _ = sections[name]
+        return np.frombuffer(mapped, dtype="<f4", count=count, offset=base + offset)
+
+    def text_column(name):
+        offset, size = sections[name]
+        values = mapped[base + offset:base + offset + size].decode("utf-8").split("\n")
+        if not count:
+            return []
+        if len(values) != count:
+            raise ValueError(f"в секции {name} {len(values)} значений вместо {count}")
+        return values
+
+    index = CityIndex(text_column("names"), text_column("codes"),
+                      array_column("lat"), array_column("lon"), keys=text_column("keys"))
+    return StationsSnapshot(path, meta, index, mtime, mapped)
+
+async def _fetch_stations_conditional(session, etag=None, last_modified=None):
+    params = {"apikey": API_KEY, "format": "json", "lang": "ru_RU"}
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    try:
+        async with get_upstream_limiter().acquire(STATIONS_URL):
+            async with session.get(STATIONS_URL, params=params, headers=headers, timeout=120) as response:
+                if response.status == 304:
+                    return 304, None, response.headers
                 response.raise_for_status()
-                data = await response.json(content_type=None)
-    except (asyncio.TimeoutError, asyncio.CancelledError):
-        data = {}
-    except Exception:
-        data = {}
-    routes = []
-    for seg in data.get("segments", []):
-        dep_str = seg.get("departure")
-        arr_str = seg.get("arrival")
-        if dep_str and arr_str:
+                return response.status, await response.json(content_type=None), response.headers
+    except (asyncio.TimeoutError, aiohttp.ClientError, ValueError):
+        return None, None, {}
+
+async def refresh_stations_snapshot(session, path, snapshot=None):
+    meta = snapshot.meta if snapshot is not None else {}
+    status, data, headers = await _fetch_stations_conditional(session, meta.get("etag"), meta.get("last_modified"))
+    if status == 304 and snapshot is not None:
+        # Данные не изменились — переписываем снимок, чтобы обновить время проверки
+        write_stations_snapshot(path, snapshot.index, meta.get("etag"), meta.get("last_modified"))
+        return load_stations_snapshot(path)
+    city_codes = parse_stations_list(data) if data else []
+    if not city_codes:
+        return None
+    write_stations_snapshot(path, build_city_index(city_codes),
+                            headers.get("ETag"), headers.get("Last-Modified"))
+    return load_stations_snapshot(path)
+
+_STATIONS_SNAPSHOT = None
+_SNAPSHOT_REFRESH_TASK = None
+_SNAPSHOT_LAST_RELOAD_CHECK = 0.0
+
+def _set_stations_snapshot(snapshot):
+    global _STATIONS_SNAPSHOT, _CITY_INDEX
+    _STATIONS_SNAPSHOT = snapshot
+    _CITY_INDEX = snapshot.index
+
+def _reload_snapshot_if_changed(path):
+    # Снимок мог обновить другой процесс: сравниваем время изменения файла не чаще раза в минуту.
+    # Возвращает True, если проверка выполнялась
+    global _SNAPSHOT_LAST_RELOAD_CHECK
+    now = time.time()
+    if now - _SNAPSHOT_LAST_RELOAD_CHECK < STATIONS_SNAPSHOT_RELOAD_CHECK_INTERVAL:
+        return False
+    _SNAPSHOT_LAST_RELOAD_CHECK = now
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return True
+    if _STATIONS_SNAPSHOT is None or mtime != _STATIONS_SNAPSHOT.mtime:
+        try:
+            _set_stations_snapshot(load_stations_snapshot(path))
+        except (OSError, ValueError, KeyError, struct.error):
+            pass
+    return True
+
+def _schedule_snapshot_refresh(path, snapshot):
+    # Без снимка (файл удалён или не был создан) обновление запускается сразу
+    global _SNAPSHOT_REFRESH_TASK
+    if snapshot is not None and snapshot.age() <= STATIONS_SNAPSHOT_MAX_AGE:
+        return
+    if _SNAPSHOT_REFRESH_TASK is None or _SNAPSHOT_REFRESH_TASK.done():
+        _SNAPSHOT_REFRESH_TASK = asyncio.ensure_future(_refresh_snapshot_in_background(path, snapshot))
+
+async def _refresh_snapshot_in_background(path, snapshot):
+    # Обновляет снимок только один процесс — тот, кто захватил файл блокировки
+    lock_file = None
+    try:
+        if fcntl is not None:
+            lock_file = open(f"{path}.lock", "w")
             try:
-                dep_time = datetime.fromisoformat(dep_str).replace(tzinfo=None)
-                arr_time = datetime.fromisoformat(arr_str).replace(tzinfo=None)
-            except Exception:
-                continue
-            if (arr_time - dep_time).total_seconds() <= 0:
-                continue
-            duration = (arr_time - dep_time).total_seconds() / 60.0
-            routes.append({
-                "departure": dep_time,
-                "arrival": arr_time,
-                "total_duration": duration,
-                "raw": seg
-            })
-    return routes
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return
+        async with ClientSession() as session:
+            refreshed = await refresh_stations_snapshot(session, path, snapshot)
+        if refreshed is not None:
+            _set_stations_snapshot(refreshed)
+    except OSError:
+        pass
+    finally:
+        if lock_file is not None:
+            lock_file.close()
+
+async def load_city_index(session, snapshot_path=None):
+    global _SNAPSHOT_LAST_RELOAD_CHECK
+    if not snapshot_path:
+        return build_city_index(await get_city_codes_async(session))
+    snapshot = None
+    try:
+        snapshot = load_stations_snapshot(snapshot_path)
+    except (OSError, ValueError, KeyError, struct.error):
+        snapshot = None
+    if snapshot is None:
+        snapshot = await refresh_stations_snapshot(session, snapshot_path)
+        if snapshot is None:
+            return build_city_index([])
+    else:
+        _schedule_snapshot_refresh(snapshot_path, snapshot)
+    _set_stations_snapshot(snapshot)
+    _SNAPSHOT_LAST_RELOAD_CHECK = time.time()
+    return snapshot.index
+
+
+# ================= Функция получения маршрутов между станциями =================
+
+async def async_get_routes(session, from_code, to_code, date, min_departure_time=None):
+    # Возвращает список Segment; у каждого доступны route["departure"], route["arrival"],
+    # route["total_duration"] и route["raw"], как у словарей маршрутов
+    return list(await async_search_segments(session, from_code, to_code, date, min_departure_time))
+
+# ================= Отбор городов пересадки по географии =================
+
+EARTH_RADIUS_KM = 6371.0
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(x, dtype=np.float64)) for x in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+def rank_transfer_hubs(city_index, dep_code, arr_code, transfer_list):
+    # Возвращает пары (город, коэффициент крюка), отсортированные по возрастанию крюка.
+    # Города без координат получают бесконечный коэффициент.
+    dep_coords = city_index.get_coords(dep_code)
+    arr_coords = city_index.get_coords(arr_code)
+    if dep_coords is None or arr_coords is None or not transfer_list:
+        return [(city, math.inf) for city in transfer_list]
+    rows = [city_index.get_row(city_index.get_code(city)) for city in transfer_list]
+    known = np.array([row is not None for row in rows])
+    safe_rows = np.array([row if row is not None else 0 for row in rows], dtype=np.int64)
+    hub_lat = np.where(known, city_index.lat[safe_rows], np.nan)
+    hub_lon = np.where(known, city_index.lon[safe_rows], np.nan)
+    direct = float(haversine_km(dep_coords[0], dep_coords[1], arr_coords[0], arr_coords[1]))
+    via = (haversine_km(dep_coords[0], dep_coords[1], hub_lat, hub_lon)
+           + haversine_km(hub_lat, hub_lon, arr_coords[0], arr_coords[1]))
+    detour = via / max(direct, TRANSFER_HUBS_MIN_DISTANCE_KM)
+    detour = np.where(np.isnan(detour), np.inf, detour)
+    order = np.argsort(detour, kind="stable")
+    return [(transfer_list[i], float(detour[i])) for i in order]
+
+def select_transfer_hubs(city_index, dep_code, arr_code, transfer_list,
+                         top_k=None, max_detour=None, min_k=None):
+    top_k = TRANSFER_HUBS_TOP_K if top_k is None else top_k
+    max_detour = TRANSFER_HUBS_MAX_DETOUR if max_detour is None else max_detour
+    min_k = TRANSFER_HUBS_MIN_K if min_k is None else min_k
+    transfer_list = [city for city in transfer_list
+                     if city_index.get_code(city) not in (None, dep_code, arr_code)]
+    ranked = rank_transfer_hubs(city_index, dep_code, arr_code, transfer_list)
+    if all(math.isinf(detour) for _, detour in ranked):
+        # Без координат отбор невозможен — ищем через все города в исходном порядке
+        return [city for city, _ in ranked]
+    selected = []
+    for city, detour in ranked:
+        if top_k and len(selected) >= top_k:
+            break
+        if len(selected) >= min_k and detour > max_detour:
+            break
+        selected.append(city)
+    return selected
+
+# ================= Стыковка этапов маршрута =================
+# Рейсы второго этапа за нужный день загружаются один раз и стыкуются с рейсами первого
+# этапа по столбцам: времена — массивы int64 в минутах, типы транспорта — коды, минимальное
+# время пересадки берётся из матрицы REQUIRED_WAIT_MINUTES. Допустимые пары
+# (departure2 >= arrival1 + wait) и их длительности считаются для всех пар сразу,
+# лучшие отбираются через argpartition, а словари маршрутов собираются только для них.
+
+def get_transport_type(route):
+    if isinstance(route, Segment):
+        return TRANSPORT_TYPES[route.transport] if route.transport < TRANSPORT_OTHER else ""
+    raw = route.get("raw")
+    if not isinstance(raw, dict):
+        return ""
+    return (raw.get("thread", {}).get("transport_type") or "").lower()
+
+def get_connection_dates(arrival_times, window_days=None):
+    if window_days is None:
+        window_days = CONNECTION_WINDOW_DAYS
+    dates = set()
+    for arrival_time in arrival_times:
+        for offset in range(window_days):
+            dates.add((arrival_time + timedelta(days=offset)).strftime("%Y-%m-%d"))
+    return sorted(dates)
+
+# Сколько пар рейсов обрабатывается за один шаг: ограничивает размер временных матриц
+JOIN_CHUNK_PAIRS = 1 << 20
+
+def segment_columns(segments):
+    # Столбцы (отправление, прибытие, тип транспорта) для списка сегментов
+    count = len(segments)
+    return (
+        np.fromiter((segment.departure_min for segment in segments), dtype=np.int64, count=count),
+        np.fromiter((segment.arrival_min for segment in segments), dtype=np.int64, count=count),
+        np.fromiter((segment.transport for segment in segments), dtype=np.intp, count=count),
+    )
+
+def join_connections(columns1, columns2, limit, max_duration=math.inf):
+    # До limit лучших стыковок в виде (длительность, номер рейса 1, номер рейса 2)
+    # по возрастанию длительности; стыковки не короче max_duration отбрасываются
+    departures1, arrivals1, transports1 = columns1
+    departures2, arrivals2, transports2 = columns2
+    if not len(departures1) or not len(departures2) or limit <= 0:
+        return []
+    rows_per_chunk = max(1, JOIN_CHUNK_PAIRS // len(departures2))
+    found_durations, found_rows, found_cols = [], [], []
+    for start in range(0, len(departures1), rows_per_chunk):
+        chunk = slice(start, start + rows_per_chunk)
+        earliest = arrivals1[chunk, None] + REQUIRED_WAIT_MINUTES[transports1[chunk, None], transports2[None, :]]
+        durations = arrivals2[None, :] - departures1[chunk, None]
+        rows, cols = np.nonzero((departures2[None, :] >= earliest) & (durations < max_duration))
+        if not len(rows):
+            continue
+        chunk_durations = durations[rows, cols]
+        if len(chunk_durations) > limit:
+            keep = np.argpartition(chunk_durations, limit - 1)[:limit]
+            rows, cols, chunk_durations = rows[keep], cols[keep], chunk_durations[keep]
+        found_durations.append(chunk_durations)
+        found_rows.append(rows + start)
+        found_cols.append(cols)
+    if not found_durations:
+        return []
+    durations = np.concatenate(found_durations)
+    rows = np.concatenate(found_rows)
+    cols = np.concatenate(found_cols)
+    if len(durations) > limit:
+        keep = np.argpartition(durations, limit - 1)[:limit]
+        durations, rows, cols = durations[keep], rows[keep], cols[keep]
+    order = np.lexsort((cols, rows, durations))
+    return list(zip(durations[order].tolist(), rows[order].tolist(), cols[order].tolist()))
+
+# Нижняя оценка (в минутах) длительности любой стыковки рейса первого этапа
+# со вторым этапом, отправляющимся в день second_date: второй этап не может
+# отправиться раньше прибытия первого и раньше начала этого дня.
+def connection_lower_bound(segment1, second_date):
+    day_start = datetime_to_minutes(datetime.strptime(second_date, "%Y-%m-%d"))
+    return float(max(segment1.arrival_min, day_start) - segment1.departure_min)
+
+# ================= Отбор лучших маршрутов =================
+# Ограниченная куча из top_n маршрутов с наименьшим total_duration. Худший из
+# сохранённых маршрутов служит порогом: запросы и стыковки, которые заведомо
+# не могут дать результат лучше порога, пропускаются.
+
+class TopRoutes:
+    def __init__(self, top_n):
+        self.top_n = max(int(top_n), 1)
+        self._heap = []
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def worst(self):
+        if len(self._heap) < self.top_n:
+            return math.inf
+        return -self._heap[0][0]
+
+    def can_improve(self, lower_bound):
+        return lower_bound < self.worst()
+
+    def push(self, route):
+        # Счётчик со знаком минус сохраняет порядок добавления при равной длительности
+        item = (-route["total_duration"], -next(self._counter), route)
+        if len(self._heap) < self.top_n:
+            heapq.heappush(self._heap, item)
+        elif item[:2] > self._heap[0][:2]:
+            heapq.heapreplace(self._heap, item)
+
+    def routes(self):
+        return [item[2] for item in sorted(self._heap, key=lambda item: (-item[0], -item[1]))]
+
+def _remaining_time(deadline_at):
+    if deadline_at is None:
+        return None
+    return max(deadline_at - asyncio.get_running_loop().time(), 0.0)
 
 # ================= Функция поиска маршрутов для одного этапа =================
 
-async def async_find_best_routes(session, city_codes_df, candidate_transfer_list,
+# Результат — SearchResult: список маршрутов с признаком partial, который выставляется,
+# если часть запросов к API завершилась ошибкой или таймаутом либо истёк deadline
+async def async_find_best_routes(session, city_index, candidate_transfer_list,
                                  departure_city, arrival_city, departure_date,
-                                 top_n=1, min_dep_time=None):
-    dep_code = get_city_code_by_name(city_codes_df, departure_city)
-    arr_code = get_city_code_by_name(city_codes_df, arrival_city)
+                                 top_n=1, min_dep_time=None, deadline=None):
+    with search_trace("best") as trace:
+        routes = await _find_best_routes(session, city_index, candidate_transfer_list,
+                                         departure_city, arrival_city, departure_date,
+                                         top_n, min_dep_time, deadline, trace)
+    return SearchResult(routes, trace.partial, trace)
+
+async def _find_best_routes(session, city_index, candidate_transfer_list,
+                            departure_city, arrival_city, departure_date,
+                            top_n, min_dep_time, deadline, trace):
+    dep_code = get_city_code_by_name(city_index, departure_city)
+    arr_code = get_city_code_by_name(city_index, arrival_city)
     if not dep_code or not arr_code:
         return []
-    
-    params = {
-        "apikey": API_KEY,
-        "format": "json",
-        "from": dep_code,
-        "to": arr_code,
-        "date": departure_date,
-        "lang": "ru_RU"
-    }
-    if min_dep_time:
-        params["min_dep_time"] = min_dep_time.strftime("%Y-%m-%dT%H:%M")
+    if deadline is None:
+        deadline = SEARCH_DEADLINE
+    deadline_at = asyncio.get_running_loop().time() + deadline if deadline is not None else None
+
     try:
-        async with session.get(SEARCH_URL, params=params, timeout=20) as response:
-            if response.status == 404:
-                direct_data = {}
-            else:
-                response.raise_for_status()
-                direct_data = await response.json(content_type=None)
-    except (asyncio.TimeoutError, asyncio.CancelledError):
-        direct_data = {}
-    except Exception:
-        direct_data = {}
+        with trace.span("direct"):
+            direct_list = await asyncio.wait_for(
+                async_get_routes(session, dep_code, arr_code, departure_date, min_dep_time),
+                _remaining_time(deadline_at)
+            )
+    except asyncio.TimeoutError:
+        mark_partial("deadline_exceeded")
+        return []
     direct_routes = []
-    for seg in direct_data.get("segments", []):
-        dep_str = seg.get("departure")
-        arr_str = seg.get("arrival")
-        if dep_str and arr_str:
-            try:
-                dep_time = datetime.fromisoformat(dep_str).replace(tzinfo=None)
-                arr_time = datetime.fromisoformat(arr_str).replace(tzinfo=None)
-            except Exception:
-                continue
-            if (arr_time - dep_time).total_seconds() <= 0:
-                continue
-            if min_dep_time and dep_time < min_dep_time:
-                continue
-            duration = (arr_time - dep_time).total_seconds() / 60.0
-            direct_routes.append({
-                "route_type": "direct",
-                "total_duration": duration,
-                "departure": dep_time,
-                "arrival": arr_time,
-                "raw": seg
-            })
+    for segment in direct_list:
+        if min_dep_time and segment.departure < min_dep_time:
+            continue
+        direct_routes.append({
+            "route_type": "direct",
+            "total_duration": segment.total_duration,
+            "departure": segment.departure,
+            "arrival": segment.arrival,
+            "segment": segment
+        })
     if direct_routes:
-        direct_routes.sort(key=lambda x: x["total_duration"])
-        return direct_routes[:top_n]
+        with trace.span("sort"):
+            direct_routes.sort(key=lambda x: x["total_duration"])
+            return [materialize_route(route) for route in direct_routes[:top_n]]
     
     # Если прямого рейса нет, ищем варианты с пересадкой.
-    candidate_transfer_dict = get_all_city_codes_dict(city_codes_df.to_dict(orient="records"))
-    candidate_transfer_dict = {city: info for city, info in candidate_transfer_dict.items() if city in candidate_transfer_list}
-    connecting_routes = []
-    
+    best_routes = TopRoutes(top_n)
+
+    def join_day(transfer_city, seg1_list, seg1_columns, second_date, day_list):
+        worst = best_routes.worst()
+        departures1, arrivals1, transports1 = seg1_columns
+        # Рейсы первого этапа, для которых стыковка в этот день может улучшить результат
+        day_start = datetime_to_minutes(datetime.strptime(second_date, "%Y-%m-%d"))
+        rows = np.flatnonzero(np.maximum(arrivals1, day_start) - departures1 < worst)
+        if not len(rows) or not day_list:
+            return
+        pairs = join_connections((departures1[rows], arrivals1[rows], transports1[rows]),
+                                 segment_columns(day_list), best_routes.top_n, worst)
+        for total_duration, i, j in pairs:
+            route1 = seg1_list[rows[i]]
+            route2 = day_list[j]
+            # Маршрут хранит компактные сегменты; словари с исходными данными
+            # собираются только для итоговых top_n (materialize_route)
+            best_routes.push({
+                "route_type": "connecting",
+                "total_duration": float(total_duration),
+                "departure": route1.departure,
+                "arrival": route2.arrival,
+                "raw": {"seg1": route1, "seg2": route2},
+                "first_leg": route1,
+                "second_leg": route2,
+                "transfer_city": transfer_city
+            })
+
     async def process_transfer_city(transfer_city):
-        transfer_info = candidate_transfer_dict.get(transfer_city)
-        if not transfer_info:
-            return []
-        transfer_code = transfer_info["code"]
-        if transfer_code in [dep_code, arr_code]:
-            return []
-        results = []
-        seg1_list = await async_get_routes(session, dep_code, transfer_code, departure_date, min_dep_time)
-        async def process_seg1(route1):
-            seg_results = []
-            if "arrival" not in route1:
-                return seg_results
-            arrival_time_transfer = route1["arrival"]
-            second_date = arrival_time_transfer.strftime("%Y-%m-%d")
-            seg2_list = await async_get_routes(session, transfer_code, arr_code, second_date, min_departure_time=arrival_time_transfer)
-            for route2 in seg2_list:
-                if "arrival" not in route2:
-                    continue
-                transport1 = route1["raw"].get("thread", {}).get("transport_type", "").lower()
-                transport2 = route2["raw"].get("thread", {}).get("transport_type", "").lower()
-                wait_time = route2["departure"] - arrival_time_transfer
-                required_wait = get_required_wait(transport1, transport2)
-                if wait_time < required_wait:
-                    continue
-                total_duration = (route2["arrival"] - route1["departure"]).total_seconds() / 60.0
-                seg_results.append({
-                    "route_type": "connecting",
-                    "total_duration": total_duration,
-                    "departure": route1["departure"],
-                    "arrival": route2["arrival"],
-                    "raw": {"seg1": route1, "seg2": route2},
-                    "first_leg": route1,
-                    "second_leg": route2,
-                    "transfer_city": transfer_city
-                })
-            return seg_results
-        
-        tasks_seg1 = [process_seg1(route1) for route1 in seg1_list]
-        seg1_results = await asyncio.gather(*tasks_seg1)
-        for sublist in seg1_results:
-            results.extend(sublist)
-        return results
-
-    tasks_transfer = [process_transfer_city(city) for city in candidate_transfer_list]
-    transfer_results = await asyncio.gather(*tasks_transfer)
-    for sublist in transfer_results:
-        connecting_routes.extend(sublist)
-    
-    if connecting_routes:
-        connecting_routes.sort(key=lambda x: x["total_duration"])
-        return connecting_routes[:top_n]
-    return []
+        transfer_code = city_index.get_code(transfer_city)
+        if not transfer_code or transfer_code in [dep_code, arr_code]:
+            return
+        with trace.span("seg1"):
+            seg1_list = await async_get_routes(session, dep_code, transfer_code, departure_date, min_dep_time)
+        # Рейсы, которые сами по себе не быстрее худшего из найденных маршрутов, не рассматриваются
+        seg1_list = [route1 for route1 in seg1_list if best_routes.can_improve(route1.total_duration)]
+        if not seg1_list:
+            return
+        seg1_columns = segment_columns(seg1_list)
+
+        async def fetch_seg2(second_date):
+            with trace.span("seg2"):
+                return await async_get_routes(session, transfer_code, arr_code, second_date)
+
+        def day_is_promising(second_date):
+            return any(best_routes.can_improve(connection_lower_bound(route1, second_date))
+                       for route1 in seg1_list)
+
+        # Второй этап запрашивается один раз на каждый день в окне после прибытия,
+        # а не отдельно для каждого рейса первого этапа
+        pending = {}
+        for second_date in get_connection_dates(route1.arrival for route1 in seg1_list):
+            if day_is_promising(second_date):
+                task = asyncio.ensure_future(fetch_seg2(second_date))
+                pending[task] = second_date
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    with trace.span("join"):
+                        join_day(transfer_city, seg1_list, seg1_columns, pending.pop(task), task.result())
+                # Запросы, которые уже не могут улучшить результат, отменяются
+                for task, second_date in list(pending.items()):
+                    if not day_is_promising(second_date):
+                        task.cancel()
+                        del pending[task]
+        finally:
+            for task in pending:
+                task.cancel()
+
+    # Города пересадки перебираются от самых перспективных (с наименьшим крюком)
+    transfer_cities = select_transfer_hubs(city_index, dep_code, arr_code, candidate_transfer_list)
+    tasks_transfer = [asyncio.ensure_future(process_transfer_city(city)) for city in transfer_cities]
+    try:
+        if tasks_transfer:
+            with trace.span("transfer_fanout"):
+                await asyncio.wait(tasks_transfer, timeout=_remaining_time(deadline_at))
+    finally:
+        # По истечении времени (или при отмене поиска) незавершённые запросы отменяются,
+        # возвращается лучшее из уже найденного
+        still_running = [task for task in tasks_transfer if not task.done()]
+        for task in still_running:
+            task.cancel()
+        if still_running:
+            await asyncio.gather(*still_running, return_exceptions=True)
+    if still_running:
+        mark_partial("deadline_exceeded")
+    with trace.span("sort"):
+        return [materialize_route(route) for route in best_routes.routes()]
 
 
 # ================= Функция поиска комбинированного маршрута =================
@@ -286,38 +1585,90 @@ async def async_find_best_routes(session, city_codes_df, candidate_transfer_list
 # Для каждого кандидата первого этапа (departure_city → arrival_city1) ищутся варианты второго этапа (arrival_city1 → arrival_city2).
 # После получения кандидатов проверяется, что время отправления второго этапа не меньше, чем время прибытия первого этапа плюс требуемый интервал,
 # рассчитываемый функцией get_required_wait с учетом типов транспорта.
-async def async_find_combined_routes(session, city_codes_df, candidate_transfer_list,
+# Поиски второго этапа выполняются по одному разу на каждую дату: на день поездки и следующий
+# день они запускаются сразу, параллельно с первым этапом, а остальные нужные даты
+# определяются по прибытиям первого этапа. Этапы объединяются в памяти.
+
+def get_arrival_transport(route):
+    # Тип транспорта, которым маршрут прибывает (для маршрута с пересадкой — второй рейс)
+    return get_transport_type(route["second_leg"] if "second_leg" in route else route)
+
+def get_departure_transport(route):
+    return get_transport_type(route["first_leg"] if "first_leg" in route else route)
+
+def join_combined_leg(leg1, leg2_candidates):
+    transport1 = get_arrival_transport(leg1)
+    return [candidate for candidate in leg2_candidates
+            if candidate["departure"] >= leg1["arrival"] + get_required_wait(transport1, get_departure_transport(candidate))]
+
+async def async_find_combined_routes(session, city_index, candidate_transfer_list,
                                      departure_city, arrival_city1, arrival_city2,
-                                     departure_date, top_n=1):
-    leg1_routes = await async_find_best_routes(session, city_codes_df, candidate_transfer_list,
-                                               departure_city, arrival_city1, departure_date, top_n=3)
-    if not leg1_routes:
-        return []
+                                     departure_date, top_n=1, deadline=None):
+    # Поиски этапов выполняются внутри общей трассы и отмечают её неполной при сбоях
+    with search_trace("combined") as trace:
+        routes = await _find_combined_routes(session, city_index, candidate_transfer_list,
+                                             departure_city, arrival_city1, arrival_city2,
+                                             departure_date, top_n, deadline, trace)
+    return SearchResult(routes, trace.partial, trace)
+
+async def _find_combined_routes(session, city_index, candidate_transfer_list,
+                                departure_city, arrival_city1, arrival_city2,
+                                departure_date, top_n, deadline, trace):
+    # deadline общий для обоих этапов: второй этап, запущенный после первого,
+    # получает только оставшееся время
+    if deadline is None:
+        deadline = SEARCH_DEADLINE
+    deadline_at = asyncio.get_running_loop().time() + deadline if deadline is not None else None
+    leg2_searches = {}
+
+    def search_leg2(leg2_date):
+        task = leg2_searches.get(leg2_date)
+        if task is None:
+            task = asyncio.ensure_future(async_find_best_routes(
+                session, city_index, candidate_transfer_list, arrival_city1, arrival_city2, leg2_date, top_n=3,
+                deadline=_remaining_time(deadline_at)
+            ))
+            leg2_searches[leg2_date] = task
+        return task
+
+    first_day = datetime.strptime(normalize_search_date(departure_date), "%Y-%m-%d")
+    speculative_dates = get_connection_dates([first_day])
+    try:
+        for leg2_date in speculative_dates:
+            search_leg2(leg2_date)
+        leg1_routes = await async_find_best_routes(session, city_index, candidate_transfer_list,
+                                                   departure_city, arrival_city1, departure_date, top_n=3,
+                                                   deadline=_remaining_time(deadline_at))
+        if not leg1_routes:
+            return []
+        # Сначала ищем варианты второго этапа на ту же дату, что и прибытие первого этапа,
+        # если на ту же дату нет подходящих вариантов – пробуем следующий день
+        same_days = [leg1["arrival"].strftime("%Y-%m-%d") for leg1 in leg1_routes]
+        next_days = [(leg1["arrival"] + timedelta(days=1)).strftime("%Y-%m-%d") for leg1 in leg1_routes]
+        needed_dates = set(same_days) | set(next_days)
+        for leg2_date in list(leg2_searches):
+            if leg2_date not in needed_dates:
+                leg2_searches.pop(leg2_date).cancel()
+        leg2_by_date = dict(zip(
+            sorted(needed_dates),
+            await asyncio.gather(*[search_leg2(leg2_date) for leg2_date in sorted(needed_dates)])
+        ))
+    finally:
+        for task in leg2_searches.values():
+            task.cancel()
+
+    with trace.span("join"):
+        combined_routes = join_combined_routes(leg1_routes, same_days, next_days, leg2_by_date)
+    with trace.span("sort"):
+        combined_routes.sort(key=lambda x: x["total_duration"])
+    return combined_routes[:top_n]
+
+def join_combined_routes(leg1_routes, same_days, next_days, leg2_by_date):
     combined_routes = []
-    for leg1 in leg1_routes:
-        candidate_leg2 = []
-        # Сначала ищем варианты второго этапа на ту же дату, что и прибытие первого этапа
-        departure_date_leg2 = leg1["arrival"].strftime("%Y-%m-%d")
-        leg2_candidates = await async_find_best_routes(session, city_codes_df, candidate_transfer_list,
-                                                       arrival_city1, arrival_city2, departure_date_leg2, top_n=3)
-        for candidate in leg2_candidates:
-            transport1 = leg1["raw"].get("thread", {}).get("transport_type", "").lower()
-            transport2 = candidate["raw"].get("thread", {}).get("transport_type", "").lower()
-            required_wait = get_required_wait(transport1, transport2)
-            if candidate["departure"] >= leg1["arrival"] + required_wait:
-                candidate_leg2.append(candidate)
-        # Если на ту же дату нет подходящих вариантов – пробуем следующий день
+    for leg1, same_day, next_day in zip(leg1_routes, same_days, next_days):
+        candidate_leg2 = join_combined_leg(leg1, leg2_by_date[same_day])
         if not candidate_leg2:
-            next_day = leg1["arrival"] + timedelta(days=1)
-            departure_date_leg2 = next_day.strftime("%Y-%m-%d")
-            leg2_candidates = await async_find_best_routes(session, city_codes_df, candidate_transfer_list,
-                                                           arrival_city1, arrival_city2, departure_date_leg2, top_n=3)
-            for candidate in leg2_candidates:
-                transport1 = leg1["raw"].get("thread", {}).get("transport_type", "").lower()
-                transport2 = candidate["raw"].get("thread", {}).get("transport_type", "").lower()
-                required_wait = get_required_wait(transport1, transport2)
-                if candidate["departure"] >= leg1["arrival"] + required_wait:
-                    candidate_leg2.append(candidate)
+            candidate_leg2 = join_combined_leg(leg1, leg2_by_date[next_day])
         # Для всех удовлетворяющих условиям вариантов второго этапа объединяем этапы
         for leg2 in candidate_leg2:
             combined_total_duration = (leg2["arrival"] - leg1["departure"]).total_seconds() / 60.0
@@ -329,8 +1680,577 @@ async def async_find_combined_routes(session, city_codes_df, candidate_transfer_
                 "departure": leg1["departure"],
                 "arrival": leg2["arrival"]
             })
-    combined_routes.sort(key=lambda x: x["total_duration"])
-    return combined_routes[:top_n]
+    return combined_routes
+
+# ================= Парето-фронт маршрутов =================
+# Один проход поиска собирает все варианты (прямые и с одной пересадкой через отобранные
+# города) и оставляет только недоминируемые по критериям: длительность, число пересадок,
+# цена (сумма минимальных цен из tickets_info; маршрут без цены считается самым дорогим).
+# Сочетание видов транспорта — отдельная категория: фронт строится для каждого сочетания,
+# поэтому, например, вариант «только поезд» не вытесняется более быстрым самолётом.
+# Сортировка и фильтры по предпочтениям пользователя (RouteFrontier.select) применяются
+# к готовому фронту без новых запросов к API; фронт кэшируется для каждого запроса.
+
+FRONTIER_SORT_KEYS = ("duration", "price", "transfers")
+
+def transport_mask(transports):
+    mask = 0
+    for transport in transports:
+        mask |= 1 << (transport if isinstance(transport, int) else transport_code(transport))
+    return mask
+
+def _segment_prices(segments):
+    return np.array([np.inf if segment.price is None else segment.price for segment in segments], dtype=np.float64)
+
+def pareto_mask(durations, prices, groups):
+    # Недоминируемые по (длительность, цена) точки внутри каждой группы
+    keep = np.zeros(len(durations), dtype=bool)
+    for group in np.unique(groups):
+        members = np.flatnonzero(groups == group)
+        order = members[np.lexsort((prices[members], durations[members]))]
+        ordered_prices = prices[order]
+        # Точка остаётся, если она дешевле всех точек, которые не длиннее её;
+        # самая короткая (и самая дешёвая из самых коротких) остаётся всегда
+        previous_min = np.minimum.accumulate(np.concatenate(([np.inf], ordered_prices[:-1])))
+        on_front = ordered_prices < previous_min
+        on_front[0] = True
+        keep[order[on_front]] = True
+    return keep
+
+def pareto_connections(columns1, prices1, columns2, prices2):
+    # Пары (номер рейса 1, номер рейса 2) на фронте (длительность, цена) для каждого
+    # сочетания видов транспорта; допустимость пересадки — как в join_connections
+    departures1, arrivals1, transports1 = columns1
+    departures2, arrivals2, transports2 = columns2
+    if not len(departures1) or not len(departures2):
+        return []
+    rows_per_chunk = max(1, JOIN_CHUNK_PAIRS // len(departures2))
+    found = []
+    for start in range(0, len(departures1), rows_per_chunk):
+        chunk = slice(start, start + rows_per_chunk)
+        earliest = arrivals1[chunk, None] + REQUIRED_WAIT_MINUTES[transports1[chunk, None], transports2[None, :]]
+        rows, cols = np.nonzero(departures2[None, :] >= earliest)
+        if not len(rows):
+            continue
+        rows += start
+        durations = arrivals2[cols] - departures1[rows]
+        prices = prices1[rows] + prices2[cols]
+        groups = (1 << transports1[rows]) | (1 << transports2[cols])
+        # Фронт части пар содержит все точки общего фронта из этой части
+        keep = pareto_mask(durations, prices, groups)
+        found.append((durations[keep], prices[keep], groups[keep], rows[keep], cols[keep]))
+    if not found:
+        return []
+    durations, prices, groups, rows, cols = (np.concatenate(column) for column in zip(*found))
+    keep = pareto_mask(durations, prices, groups)
+    return list(zip(rows[keep].tolist(), cols[keep].tolist()))
+
+def pareto_front(routes):
+    # Недоминируемые маршруты по (длительность, пересадки, цена) внутри сочетания транспорта
+    def price_key(route):
+        return math.inf if route["price"] is None else route["price"]
+
+    front, kept = [], {}
+    for route in sorted(routes, key=lambda r: (r["total_duration"], r["transfers"], price_key(r))):
+        group = kept.setdefault(transport_mask(route["transports"]), [])
+        price = price_key(route)
+        if any(transfers <= route["transfers"] and kept_price <= price for transfers, kept_price in group):
+            continue
+        group.append((route["transfers"], price))
+        front.append(route)
+    return front
+
+def _route_price(segments):
+    prices = [segment.price for segment in segments]
+    return None if any(price is None for price in prices) else sum(prices)
+
+def direct_frontier_route(segment):
+    return {
+        "route_type": "direct",
+        "total_duration": segment.total_duration,
+        "departure": segment.departure,
+        "arrival": segment.arrival,
+        "segment": segment,
+        "transfers": 0,
+        "price": segment.price,
+        "transports": (transport_name(segment.transport),),
+    }
+
+def connecting_frontier_route(route1, route2, transfer_city):
+    return {
+        "route_type": "connecting",
+        "total_duration": float(route2.arrival_min - route1.departure_min),
+        "departure": route1.departure,
+        "arrival": route2.arrival,
+        "raw": {"seg1": route1, "seg2": route2},
+        "first_leg": route1,
+        "second_leg": route2,
+        "transfer_city": transfer_city,
+        "transfers": 1,
+        "price": _route_price((route1, route2)),
+        "transports": tuple(transport_name(code) for code in sorted({route1.transport, route2.transport})),
+    }
+
+class RouteFrontier:
+    # Парето-фронт маршрутов одного запроса; маршруты хранятся в компактном виде
+    def __init__(self, routes, partial=False):
+        self.routes = list(routes)
+        self.partial = partial
+        self.durations = np.array([route["total_duration"] for route in self.routes], dtype=np.float64)
+        self.transfers = np.array([route["transfers"] for route in self.routes], dtype=np.int64)
+        self.prices = np.array([np.inf if route["price"] is None else route["price"] for route in self.routes],
+                               dtype=np.float64)
+        self.masks = np.array([transport_mask(route["transports"]) for route in self.routes], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.routes)
+
+    def select(self, sort="duration", transports=None, max_transfers=None, max_price=None,
+               max_duration=None, top_n=None):
+        # sort — один из FRONTIER_SORT_KEYS или словарь весов {"duration": 1, "price": 0.05, "transfers": 60};
+        # transports — допустимые виды транспорта (например, {"train"} — только поезда)
+        selected = np.ones(len(self.routes), dtype=bool)
+        if transports:
+            selected &= (self.masks & ~transport_mask(transports)) == 0
+        if max_transfers is not None:
+            selected &= self.transfers <= max_transfers
+        if max_price is not None:
+            selected &= self.prices <= max_price
+        if max_duration is not None:
+            selected &= self.durations <= max_duration
+        rows = np.flatnonzero(selected)
+        durations, transfers, prices = self.durations[rows], self.transfers[rows], self.prices[rows]
+        if isinstance(sort, dict):
+            unknown = set(sort) - set(FRONTIER_SORT_KEYS)
+            if unknown:
+                raise ValueError(f"неизвестные критерии: {', '.join(sorted(unknown))}")
+            score = sort.get("duration", 0) * durations + sort.get("transfers", 0) * transfers
+            # Цена учитывается, только если у неё ненулевой вес; маршрут без цены тогда последний
+            if sort.get("price"):
+                score = score + np.where(np.isinf(prices), np.inf, sort["price"] * prices)
+            order = np.lexsort((prices, transfers, durations, score))
+        elif sort == "duration":
+            order = np.lexsort((prices, transfers, durations))
+        elif sort == "price":
+            order = np.lexsort((transfers, durations, prices))
+        elif sort == "transfers":
+            order = np.lexsort((prices, durations, transfers))
+        else:
+            raise ValueError(f"неизвестная сортировка: {sort!r}")
+        if top_n is not None:
+            order = order[:top_n]
+        return SearchResult([materialize_route(self.routes[row]) for row in rows[order]], self.partial)
+
+_FRONTIER_CACHE = OrderedDict()
+
+def _get_cached_frontier(key):
+    entry = _FRONTIER_CACHE.get(key)
+    if entry is None:
+        return None
+    frontier, expires_at = entry
+    if expires_at <= time.time():
+        del _FRONTIER_CACHE[key]
+        return None
+    _FRONTIER_CACHE.move_to_end(key)
+    return frontier
+
+def _cache_frontier(key, frontier, ttl):
+    _FRONTIER_CACHE[key] = (frontier, time.time() + ttl)
+    _FRONTIER_CACHE.move_to_end(key)
+    while len(_FRONTIER_CACHE) > FRONTIER_CACHE_MAX_ENTRIES:
+        _FRONTIER_CACHE.popitem(last=False)
+
+async def async_find_route_frontier(session, city_index, candidate_transfer_list,
+                                    departure_city, arrival_city, departure_date,
+                                    min_dep_time=None, deadline=None):
+    dep_code = get_city_code_by_name(city_index, departure_city)
+    arr_code = get_city_code_by_name(city_index, arrival_city)
+    if not dep_code or not arr_code:
+        return RouteFrontier([])
+    key = make_routes_cache_key(dep_code, arr_code, departure_date, min_dep_time) + (tuple(candidate_transfer_list),)
+    frontier = _get_cached_frontier(key)
+    if frontier is not None:
+        return frontier
+    with search_trace("frontier") as trace:
+        routes = await _find_frontier_routes(session, city_index, candidate_transfer_list, dep_code, arr_code,
+                                             departure_date, min_dep_time, deadline, trace)
+        with trace.span("sort"):
+            frontier = RouteFrontier(pareto_front(routes), trace.partial)
+    # Неполный фронт не кэшируется: следующий запрос попробует получить недостающие данные
+    if not frontier.partial:
+        _cache_frontier(key, frontier, get_cache_ttl(key[2]))
+    return frontier
+
+async def _find_frontier_routes(session, city_index, candidate_transfer_list, dep_code, arr_code,
+                                departure_date, min_dep_time, deadline, trace):
+    if deadline is None:
+        deadline = SEARCH_DEADLINE
+    deadline_at = asyncio.get_running_loop().time() + deadline if deadline is not None else None
+    routes = []
+
+    async def process_direct():
+        with trace.span("direct"):
+            segments = await async_get_routes(session, dep_code, arr_code, departure_date, min_dep_time)
+        routes.extend(direct_frontier_route(segment) for segment in segments
+                      if not min_dep_time or segment.departure >= min_dep_time)
+
+    async def process_transfer_city(transfer_city):
+        transfer_code = city_index.get_code(transfer_city)
+        if not transfer_code or transfer_code in (dep_code, arr_code):
+            return
+        with trace.span("seg1"):
+            seg1_list = await async_get_routes(session, dep_code, transfer_code, departure_date, min_dep_time)
+        if not seg1_list:
+            return
+        seg1_columns, seg1_prices = segment_columns(seg1_list), _segment_prices(seg1_list)
+        second_dates = get_connection_dates(route1.arrival for route1 in seg1_list)
+        with trace.span("seg2"):
+            day_lists = await asyncio.gather(*[async_get_routes(session, transfer_code, arr_code, second_date)
+                                               for second_date in second_dates])
+        with trace.span("join"):
+            for day_list in day_lists:
+                for i, j in pareto_connections(seg1_columns, seg1_prices,
+                                               segment_columns(day_list), _segment_prices(day_list)):
+                    routes.append(connecting_frontier_route(seg1_list[i], day_list[j], transfer_city))
+
+    transfer_cities = select_transfer_hubs(city_index, dep_code, arr_code, candidate_transfer_list)
+    tasks = [asyncio.ensure_future(process_direct())]
+    tasks.extend(asyncio.ensure_future(process_transfer_city(city)) for city in transfer_cities)
+    try:
+        with trace.span("transfer_fanout"):
+            await asyncio.wait(tasks, timeout=_remaining_time(deadline_at))
+    finally:
+        still_running = [task for task in tasks if not task.done()]
+        for task in still_running:
+            task.cancel()
+        if still_running:
+            await asyncio.gather(*still_running, return_exceptions=True)
+    if still_running:
+        mark_partial("deadline_exceeded")
+    return routes
+
+# ================= Пакетный поиск =================
+# Для набора запросов (departure_city, arrival_city[, arrival_city2], date) сначала
+# собирается общий план запросов к API без повторов: прямые рейсы по всем этапам,
+# затем первые плечи через города пересадки для этапов без прямых рейсов. План
+# выполняется через одну ClientSession, после чего каждый запрос решается обычными
+# функциями поиска: данные берутся из кэша, а оставшиеся одинаковые запросы
+# (вторые плечи) объединяются на лету.
+
+def create_client_session():
+    # Сессия рассчитана на весь срок работы процесса: соединения с API переиспользуются
+    # между поисками, адреса хостов кэшируются
+    connector = aiohttp.TCPConnector(
+        limit=UPSTREAM_MAX_CONCURRENCY,
+        limit_per_host=UPSTREAM_MAX_CONCURRENCY_PER_HOST,
+        keepalive_timeout=UPSTREAM_KEEPALIVE_TIMEOUT,
+        use_dns_cache=True,
+        ttl_dns_cache=UPSTREAM_DNS_CACHE_TTL
+    )
+    return ClientSession(connector=connector)
+
+def parse_route_query(query):
+    # Запрос: кортеж (откуда, куда, дата), (откуда, куда, куда2, дата) или словарь с теми же полями.
+    # Некорректная дата — ValueError для этого запроса, а не сбой всего пакета
+    if isinstance(query, dict):
+        departure_city, arrival_city = query["departure_city"], query["arrival_city"]
+        arrival_city2, departure_date = query.get("arrival_city2"), query["departure_date"]
+    elif len(query) == 3:
+        departure_city, arrival_city, departure_date = query
+        arrival_city2 = None
+    else:
+        departure_city, arrival_city, arrival_city2, departure_date = query
+    departure_date = normalize_search_date(departure_date)
+    try:
+        datetime.strptime(departure_date, "%Y-%m-%d")
+    except ValueError:
+        raise ValueError(f"некорректная дата: {departure_date!r}")
+    return departure_city, arrival_city, arrival_city2 or None, departure_date
+
+async def async_find_routes(session, city_index, departure_city, arrival_city, departure_date,
+                            arrival_city2=None, top_n=1, transfer_list=None, deadline=None):
+    if transfer_list is None:
+        transfer_list = candidate_transfer_list
+    if arrival_city2:
+        return await async_find_combined_routes(session, city_index, transfer_list, departure_city,
+                                                arrival_city, arrival_city2, departure_date, top_n=top_n,
+                                                deadline=deadline)
+    return await async_find_best_routes(session, city_index, transfer_list, departure_city,
+                                        arrival_city, departure_date, top_n=top_n, deadline=deadline)
+
+def plan_batch_legs(city_index, queries):
+    # Этапы (код отправления, код прибытия, дата), которые понадобятся для решения запросов.
+    # Дата второго этапа составного маршрута зависит от прибытия первого, поэтому
+    # заранее запрашиваются дата поездки и следующий день.
+    legs = set()
+    for departure_city, arrival_city, arrival_city2, departure_date in queries:
+        dep_code = city_index.get_code(departure_city)
+        arr_code = city_index.get_code(arrival_city)
+        if not dep_code or not arr_code:
+            continue
+        legs.add((dep_code, arr_code, departure_date))
+        arr2_code = city_index.get_code(arrival_city2) if arrival_city2 else None
+        if arr2_code:
+            day = datetime.strptime(departure_date, "%Y-%m-%d")
+            for offset in range(CONNECTION_WINDOW_DAYS):
+                legs.add((arr_code, arr2_code, (day + timedelta(days=offset)).strftime("%Y-%m-%d")))
+    return legs
+
+async def _prefetch(session, keys, deadline_at=None):
+    # Запросы, не успевшие до deadline, отменяются; недостающие данные поиски запросят сами
+    tasks = [asyncio.ensure_future(async_search_segments(session, *key)) for key in keys]
+    if tasks:
+        _, pending = await asyncio.wait(tasks, timeout=_remaining_time(deadline_at))
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return len(keys)
+
+async def async_find_routes_batch(queries, city_index=None, session=None, top_n=1, transfer_list=None,
+                                  deadline=None):
+    # deadline ограничивает весь пакет: поиски получают время, оставшееся после предзагрузки
+    if transfer_list is None:
+        transfer_list = candidate_transfer_list
+    if deadline is None:
+        deadline = SEARCH_DEADLINE
+    # Запрос, который не удалось разобрать, получает пустой результат с описанием ошибки
+    parsed, errors = [], {}
+    for i, query in enumerate(queries):
+        try:
+            parsed.append(parse_route_query(query))
+        except (KeyError, ValueError, TypeError) as e:
+            errors[i] = SearchResult(error=str(e))
+    queries = parsed
+    own_session = session is None
+    if own_session:
+        session = create_client_session()
+    try:
+        deadline_at = asyncio.get_running_loop().time() + deadline if deadline is not None else None
+        if city_index is None:
+            city_index = await get_city_index_async(session)
+        # Шаг 1: прямые рейсы по всем этапам
+        legs = plan_batch_legs(city_index, queries)
+        await _prefetch(session, legs, deadline_at)
+        # Шаг 2: первые плечи через города пересадки для этапов без прямых рейсов
+        first_legs = set()
+        for dep_code, arr_code, leg_date in legs:
+            if routes_cache.get(make_routes_cache_key(dep_code, arr_code, leg_date)):
+                continue
+            for transfer_city in select_transfer_hubs(city_index, dep_code, arr_code, transfer_list):
+                first_legs.add((dep_code, city_index.get_code(transfer_city), leg_date))
+        await _prefetch(session, first_legs - legs, deadline_at)
+        # Шаг 3: решение каждого запроса; повторяющиеся вторые плечи объединяются
+        remaining = _remaining_time(deadline_at)
+        results = iter(await asyncio.gather(*[
+            async_find_routes(session, city_index, departure_city, arrival_city, departure_date,
+                              arrival_city2, top_n=top_n, transfer_list=transfer_list, deadline=remaining)
+            for departure_city, arrival_city, arrival_city2, departure_date in queries
+        ]))
+        return [errors[i] if i in errors else next(results) for i in range(len(queries) + len(errors))]
+    finally:
+        if own_session:
+            await session.close()
+
+# ================= Маршрутизация по расписанию из кэша =================
+# Сегменты, уже полученные из API и сохранённые в кэше, загружаются в массивы:
+# остановки — города (коды из параметров запроса), рейсы — отдельные сегменты между ними.
+# Поиск идёт по раундам, как в RAPTOR: в раунде k находятся самые ранние прибытия,
+# достижимые за k рейсов; отправления из исходного города перебираются от поздних
+# к ранним с общими метками (rRAPTOR). Метка хранится для пары (город, тип прибывшего транспорта),
+# потому что минимальное время пересадки (get_required_wait) зависит от обоих рейсов.
+# Результат — фронт Парето по (время в пути, число пересадок).
+
+NO_TIME = np.iinfo(np.int64).max
+
+class TimetableGraph:
+    def __init__(self, connections):
+        stops = {}
+        rows = []
+        seen = set()
+        for from_code, to_code, segment in connections:
+            dep, arr = segment.departure_min, segment.arrival_min
+            # Один и тот же рейс может лежать в нескольких записях кэша (с min_dep_time и без)
+            key = (from_code, to_code, dep, arr, segment.uid or segment.number)
+            if key in seen:
+                continue
+            seen.add(key)
+            from_idx = stops.setdefault(from_code, len(stops))
+            to_idx = stops.setdefault(to_code, len(stops))
+            rows.append((from_idx, to_idx, dep, arr, segment.transport, segment))
+        self.stops = tuple(stops)
+        self.stop_index = MappingProxyType(stops)
+        self.n_types = TRANSPORT_OTHER + 1
+        from_idx = np.array([row[0] for row in rows], dtype=np.int64)
+        ttype = np.array([row[4] for row in rows], dtype=np.int64)
+        dep = np.array([row[2] for row in rows], dtype=np.int64)
+        # Рейсы упорядочены по (город отправления, тип транспорта, время отправления),
+        # offsets[stop * n_types + type] — начало группы в массивах
+        order = np.lexsort((dep, ttype, from_idx))
+        self.from_idx = from_idx[order]
+        self.to_idx = np.array([row[1] for row in rows], dtype=np.int64)[order]
+        self.dep = dep[order]
+        self.arr = np.array([row[3] for row in rows], dtype=np.int64)[order]
+        self.ttype = ttype[order]
+        self.segments = [rows[i][5] for i in order]
+        groups = self.from_idx * self.n_types + self.ttype
+        self.offsets = np.searchsorted(groups, np.arange(len(self.stops) * self.n_types + 1))
+        # Составной ключ (группа, отправление) упорядочен так же, как рейсы: поиск первого
+        # подходящего рейса сразу для многих групп — один вызов searchsorted
+        self._key_scale = int(self.dep.max()) + 2 if len(rows) else 1
+        self._group_dep = groups * self._key_scale + self.dep
+
+    def __len__(self):
+        return len(self.segments)
+
+    def _trace(self, labels_parent, legs, stop, transport):
+        parent_conn, parent_type = labels_parent
+        conns = []
+        while legs > 0:
+            conn = parent_conn[legs, stop, transport]
+            conns.append(int(conn))
+            stop, transport = self.from_idx[conn], parent_type[legs, stop, transport]
+            legs -= 1
+        return conns[::-1]
+
+    def find_journeys(self, origin_code, target_code, departure_date, max_transfers=3):
+        origin = self.stop_index.get(origin_code)
+        target = self.stop_index.get(target_code)
+        if origin is None or target is None or origin == target:
+            return []
+        day_start = datetime_to_minutes(datetime.strptime(normalize_search_date(departure_date), "%Y-%m-%d"))
+        day_end = day_start + 24 * 60
+        max_legs = max_transfers + 1
+        # Профильный поиск (rRAPTOR): первые рейсы перебираются от самого позднего к самому
+        # раннему, метки раундов сохраняются между ними. Маршрут из более раннего отправления
+        # нужен, только если он прибывает раньше уже найденных, поэтому каждый следующий
+        # первый рейс проверяет лишь улучшения меток.
+        lo, hi = self.offsets[origin * self.n_types], self.offsets[(origin + 1) * self.n_types]
+        firsts = lo + np.flatnonzero((self.dep[lo:hi] >= day_start) & (self.dep[lo:hi] < day_end))
+        firsts = firsts[np.argsort(-self.dep[firsts], kind="stable")]
+        shape = (max_legs + 1, len(self.stops), self.n_types)
+        labels = np.full(shape, NO_TIME)
+        labels_parent = (np.full(shape, -1), np.full(shape, -1))
+        parent_conn, parent_type = labels_parent
+        journeys = []
+        for first in firsts:
+            departure = self.dep[first]
+            # Город отправления достигнут в момент отправления: рейсы, возвращающиеся в него, не улучшают метку
+            labels[0, origin, :] = departure
+            stop, transport, arrival = self.to_idx[first], self.ttype[first], self.arr[first]
+            if arrival >= min(labels[0, stop, transport], labels[1, stop, transport]) \
+                    or arrival >= labels[:2, target].min():
+                continue
+            labels[1, stop, transport] = arrival
+            parent_conn[1, stop, transport] = first
+            parent_type[1, stop, transport] = 0
+            if stop == target:
+                journeys.append((int(arrival - departure), 1, [int(first)]))
+                continue
+            # Метки, от которых продолжается поиск, и города на пути к каждой из них
+            marked_stops = np.array([stop])
+            marked_types = np.array([transport])
+            marked_arrivals = np.array([arrival])
+            paths = np.zeros((1, len(self.stops)), dtype=bool)
+            paths[0, [origin, stop]] = True
+            for legs in range(2, max_legs + 1):
+                bound = labels[:legs + 1].min(axis=0)
+                target_bound = bound[target].min()
+                # Для каждой пары (метка, тип следующего рейса) — рейсы, отправляющиеся после
+                # минимальной пересадки и раньше лучшего известного прибытия в пункт назначения
+                sources = np.repeat(np.arange(len(marked_stops)), self.n_types)
+                next_types = np.tile(np.arange(self.n_types), len(marked_stops))
+                groups = marked_stops[sources] * self.n_types + next_types
+                ready = marked_arrivals[sources] + REQUIRED_WAIT_MINUTES[marked_types[sources], next_types]
+                starts = np.searchsorted(self._group_dep, groups * self._key_scale + ready)
+                ends = self.offsets[groups + 1]
+                if target_bound != NO_TIME:
+                    ends = np.minimum(ends, np.searchsorted(
+                        self._group_dep, groups * self._key_scale + min(int(target_bound), self._key_scale - 1)))
+                counts = np.maximum(ends - starts, 0)
+                total = int(counts.sum())
+                if not total:
+                    break
+                candidate_sources = np.repeat(sources, counts)
+                candidates = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(total)
+                # Маршрут не возвращается в города, через которые уже прошёл
+                fresh = ~paths[candidate_sources, self.to_idx[candidates]]
+                candidates, candidate_sources = candidates[fresh], candidate_sources[fresh]
+                if not len(candidates):
+                    break
+                arrivals = self.arr[candidates]
+                keys = self.to_idx[candidates] * self.n_types + self.ttype[candidates]
+                # Для каждой пары (город, тип транспорта) берём рейс с самым ранним прибытием
+                order = np.lexsort((arrivals, keys))
+                sorted_keys = keys[order]
+                winners = order[np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])]
+                conns = candidates[winners]
+                stops, transports, arrivals = self.to_idx[conns], self.ttype[conns], arrivals[winners]
+                winner_sources = candidate_sources[winners]
+                improved = (arrivals < bound[stops, transports]) & (arrivals < target_bound)
+                labels[legs, stops[improved], transports[improved]] = arrivals[improved]
+                parent_conn[legs, stops[improved], transports[improved]] = conns[improved]
+                parent_type[legs, stops[improved], transports[improved]] = marked_types[winner_sources[improved]]
+                reached = np.flatnonzero(improved & (stops == target))
+                if len(reached):
+                    best = reached[arrivals[reached].argmin()]
+                    journeys.append((int(arrivals[best] - departure), legs,
+                                     self._trace(labels_parent, legs, target, transports[best])))
+                keep = improved & (stops != target)
+                if not keep.any():
+                    break
+                marked_stops, marked_types, marked_arrivals = stops[keep], transports[keep], arrivals[keep]
+                paths = paths[winner_sources[keep]]
+                paths[np.arange(len(marked_stops)), marked_stops] = True
+        # Фронт Парето: маршрут с большим числом пересадок нужен, только если он быстрее
+        journeys.sort(key=lambda x: (x[1], x[0]))
+        front = []
+        for duration, legs, conns in journeys:
+            if not front or (duration < front[-1][0] and legs > front[-1][1]):
+                front.append((duration, legs, conns))
+        return front
+
+def iter_cached_connections(cache=None):
+    cache = routes_cache if cache is None else cache
+    for key, segments in cache.items():
+        for segment in segments:
+            yield key[0], key[1], segment
+
+def build_timetable_graph(cache=None):
+    return TimetableGraph(iter_cached_connections(cache))
+
+def journey_to_route(graph, conns, city_index=None):
+    legs = [graph.segments[conn] for conn in conns]
+    transfer_codes = [graph.stops[graph.to_idx[conn]] for conn in conns[:-1]]
+    transfer_cities = [(city_index.get_name(code) if city_index is not None else None) or code
+                       for code in transfer_codes]
+    route = {
+        "route_type": "direct" if len(legs) == 1 else "connecting" if len(legs) == 2 else "multi",
+        "total_duration": float(legs[-1].arrival_min - legs[0].departure_min),
+        "departure": legs[0].departure,
+        "arrival": legs[-1].arrival,
+        "transfers": len(legs) - 1,
+    }
+    if len(legs) == 1:
+        route["segment"] = legs[0]
+    elif len(legs) == 2:
+        route.update({
+            "raw": {"seg1": legs[0], "seg2": legs[1]},
+            "first_leg": legs[0],
+            "second_leg": legs[1],
+            "transfer_city": transfer_cities[0]
+        })
+    else:
+        route.update({"legs": legs, "transfer_cities": transfer_cities})
+    return materialize_route(route)
+
+def find_multi_transfer_routes(graph, city_index, departure_city, arrival_city,
+                               departure_date, max_transfers=3):
+    dep_code = get_city_code_by_name(city_index, departure_city)
+    arr_code = get_city_code_by_name(city_index, arrival_city)
+    if not dep_code or not arr_code:
+        return []
+    front = graph.find_journeys(dep_code, arr_code, departure_date, max_transfers)
+    return [journey_to_route(graph, conns, city_index) for _, _, conns in front]
 
 # ================= Функции форматирования маршрутов =================
 
@@ -364,6 +2284,19 @@ def format_route(candidate, departure_city, arrival_city):
         return (f"Номер рейса: {number}\nТранспорт: {transport}\nМаршрут: {route_str}\n"
                 f"Место пересадки: {transfer_station}\nВремя в пути: {duration:.0f} мин\n"
                 f"Отправление: {dep_time}\nПрибытие: {arr_time}\n")
+    elif candidate["route_type"] == "multi":
+        legs = candidate.get("legs", [])
+        threads = [leg.get("raw", {}).get("thread", {}) if isinstance(leg.get("raw"), dict) else {} for leg in legs]
+        number = " / ".join(thread.get("number", "N/A") for thread in threads)
+        transport = " / ".join(thread.get("transport_type", "N/A") for thread in threads)
+        transfer_stations = candidate.get("transfer_cities", [])
+        route_str = " -> ".join([departure_city] + list(transfer_stations) + [arrival_city])
+        duration = candidate["total_duration"]
+        dep_time = candidate["departure"].strftime("%Y-%m-%d %H:%M")
+        arr_time = candidate["arrival"].strftime("%Y-%m-%d %H:%M")
+        return (f"Номер рейса: {number}\nТранспорт: {transport}\nМаршрут: {route_str}\n"
+                f"Места пересадки: {', '.join(transfer_stations)}\nВремя в пути: {duration:.0f} мин\n"
+                f"Отправление: {dep_time}\nПрибытие: {arr_time}\n")
 
 def format_complex_route(candidate, departure_city, transfer_city, arrival_city):
     leg1_info = format_route(candidate["first_leg"], departure_city, transfer_city)
@@ -373,6 +2306,294 @@ def format_complex_route(candidate, departure_city, transfer_city, arrival_city)
             f"Этап 2 (от {transfer_city} до {arrival_city}):\n{leg2_info}\n"
             f"Общее время в пути: {total:.0f} мин\n")
 
+# ================= HTTP-сервис =================
+# Постоянно работающий сервис для интерфейса сайта. Каждый процесс держит одну
+# ClientSession с пулом соединений к API и загружает индекс городов один раз при запуске;
+# все поиски выполняются в одном цикле событий и делят кэш ответов и объединение запросов.
+# Несколько процессов-обработчиков слушают один порт (SO_REUSEPORT) и отображают в память
+# один и тот же снимок списка станций, который готовится до их запуска.
+#
+#   GET  /api/cities?q=Сам&limit=10                     — подсказки городов
+#   GET  /api/routes?from=...&to=...&stop=...&date=...  — поиск (stop — промежуточный город);
+#        без stop также sort=duration|price|transfers, transports=train,bus, max_transfers,
+#        max_price — выбор из Парето-фронта, повторные запросы отвечаются из кэша фронта;
+#        без этих параметров — top_n самых быстрых маршрутов, как в async_find_best_routes
+#   POST /api/routes/batch {"queries": [...], "top_n": 1}
+#   GET  /metrics, GET /health
+
+class ServiceError(Exception):
+    pass
+
+def parse_service_date(value):
+    # Дата из формы сайта (ДД.ММ.ГГГГ) или в формате API (ГГГГ-ММ-ДД)
+    value = (value or "").strip()
+    for fmt in ("%Y-%m-%d", "%d.%m.%Y"):
+        try:
+            return datetime.strptime(value, fmt).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    raise ServiceError(f"некорректная дата: {value!r}")
+
+def parse_service_top_n(value, default=1):
+    try:
+        top_n = int(value) if value not in (None, "") else default
+    except (TypeError, ValueError):
+        raise ServiceError(f"некорректное значение top_n: {value!r}")
+    return max(1, min(top_n, SERVICE_MAX_TOP_N))
+
+def parse_service_number(value, name, cast=float):
+    if value in (None, ""):
+        return None
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        raise ServiceError(f"некорректное значение {name}: {value!r}")
+
+SERVICE_PREFERENCE_PARAMS = ("sort", "transports", "max_transfers", "max_price")
+
+def parse_service_preference(query):
+    # None, если предпочтения не заданы: тогда ищутся top_n самых быстрых маршрутов
+    if not any(query.get(name) for name in SERVICE_PREFERENCE_PARAMS):
+        return None
+    sort = query.get("sort") or "duration"
+    if sort not in FRONTIER_SORT_KEYS:
+        raise ServiceError(f"sort — одно из значений: {', '.join(FRONTIER_SORT_KEYS)}")
+    transports = {transport.strip().lower() for transport in (query.get("transports") or "").split(",")
+                  if transport.strip()}
+    unknown = transports - set(TRANSPORT_TYPES) - {"other"}
+    if unknown:
+        raise ServiceError(f"неизвестные виды транспорта: {', '.join(sorted(unknown))}")
+    return {
+        "sort": sort,
+        "transports": transports or None,
+        "max_transfers": parse_service_number(query.get("max_transfers"), "max_transfers", int),
+        "max_price": parse_service_number(query.get("max_price"), "max_price"),
+    }
+
+def parse_service_batch_query(query, position):
+    # Запрос пакета — объект с полями departure_city, arrival_city, departure_date и необязательным arrival_city2
+    if not isinstance(query, dict):
+        raise ServiceError(f"запрос {position}: ожидается объект с полями departure_city, arrival_city, departure_date")
+    fields = {}
+    for name in ("departure_city", "arrival_city", "arrival_city2"):
+        value = query.get(name)
+        if value is not None and not isinstance(value, str):
+            raise ServiceError(f"запрос {position}: поле {name} должно быть строкой")
+        fields[name] = (value or "").strip()
+    for name in ("departure_city", "arrival_city"):
+        if not fields[name]:
+            raise ServiceError(f"запрос {position}: поле {name} обязательно")
+    if not query.get("departure_date"):
+        raise ServiceError(f"запрос {position}: поле departure_date обязательно")
+    if not isinstance(query["departure_date"], str):
+        raise ServiceError(f"запрос {position}: поле departure_date должно быть строкой")
+    try:
+        fields["departure_date"] = parse_service_date(query["departure_date"])
+    except ServiceError as e:
+        raise ServiceError(f"запрос {position}: {e}")
+    fields["arrival_city2"] = fields["arrival_city2"] or None
+    return fields
+
+def _leg_to_json(route):
+    raw = route.get("raw") if isinstance(route.get("raw"), dict) else {}
+    thread = raw.get("thread", {})
+    return {
+        "number": thread.get("number"),
+        "title": thread.get("title"),
+        "transport_type": thread.get("transport_type"),
+        "carrier": (thread.get("carrier") or {}).get("title"),
+        "from": (raw.get("from") or {}).get("title"),
+        "to": (raw.get("to") or {}).get("title"),
+        "departure": route["departure"].isoformat(),
+        "arrival": route["arrival"].isoformat(),
+        "duration": route["total_duration"],
+        "price": parse_ticket_price(raw),
+    }
+
+def route_legs(route):
+    # Отдельные рейсы маршрута в порядке следования
+    route_type = route.get("route_type")
+    if route_type == "combined":
+        return route_legs(route["first_leg"]) + route_legs(route["second_leg"])
+    if route_type == "connecting":
+        return [route["first_leg"], route["second_leg"]]
+    if route_type == "multi":
+        return list(route.get("legs", []))
+    return [route]
+
+def route_to_json(route):
+    legs = [_leg_to_json(leg) for leg in route_legs(route)]
+    prices = [leg["price"] for leg in legs]
+    return {
+        "route_type": route["route_type"],
+        "total_duration": route["total_duration"],
+        "departure": route["departure"].isoformat(),
+        "arrival": route["arrival"].isoformat(),
+        "transfers": max(len(legs) - 1, 0),
+        "price": None if None in prices else sum(prices),
+        "transports": sorted({leg["transport_type"] or "other" for leg in legs}),
+        "legs": legs,
+    }
+
+def search_result_to_json(routes):
+    result = {
+        "routes": [route_to_json(route) for route in routes],
+        "partial": bool(getattr(routes, "partial", False)),
+    }
+    if getattr(routes, "error", None):
+        result["error"] = routes.error
+    return result
+
+def _json_response(payload, status=200):
+    return web.json_response(payload, status=status,
+                             dumps=lambda data: json.dumps(data, ensure_ascii=False))
+
+async def _service_city_index(app):
+    # Индекс загружен при запуске; вызов лишь проверяет, не обновил ли снимок другой процесс
+    return await get_city_index_async(app["session"])
+
+async def handle_cities(request):
+    city_index = await _service_city_index(request.app)
+    try:
+        limit = max(1, min(int(request.query.get("limit", 10)), 50))
+    except ValueError:
+        return _json_response({"error": "некорректное значение limit"}, status=400)
+    suggestions = city_index.suggest(request.query.get("q", ""), limit=limit)
+    cities = []
+    for city in suggestions:
+        lat, lon = city_index.get_coords(city["Yandex-код"]) or (None, None)
+        cities.append({"name": city["Город"], "code": city["Yandex-код"], "lat": lat, "lon": lon})
+    return _json_response({"cities": cities})
+
+async def handle_routes(request):
+    query = request.query
+    try:
+        departure_city = query.get("from", "").strip()
+        arrival_city = query.get("to", "").strip()
+        if not departure_city or not arrival_city:
+            raise ServiceError("параметры from и to обязательны")
+        departure_date = parse_service_date(query.get("date"))
+        top_n = parse_service_top_n(query.get("top_n"))
+        preference = parse_service_preference(query)
+    except ServiceError as e:
+        return _json_response({"error": str(e)}, status=400)
+    # Промежуточная остановка из формы: from → stop → to
+    stop = query.get("stop", "").strip()
+    app = request.app
+    city_index = await _service_city_index(app)
+    if stop:
+        routes = await async_find_combined_routes(app["session"], city_index, candidate_transfer_list,
+                                                  departure_city, stop, arrival_city, departure_date, top_n=top_n,
+                                                  deadline=SERVICE_SEARCH_DEADLINE)
+    elif preference is None:
+        routes = await async_find_best_routes(app["session"], city_index, candidate_transfer_list,
+                                              departure_city, arrival_city, departure_date, top_n=top_n,
+                                              deadline=SERVICE_SEARCH_DEADLINE)
+    else:
+        # Фронт строится по всем городам пересадки, поэтому используется только при заданных
+        # сортировке или фильтрах
+        frontier = await async_find_route_frontier(app["session"], city_index, candidate_transfer_list,
+                                                   departure_city, arrival_city, departure_date,
+                                                   deadline=SERVICE_SEARCH_DEADLINE)
+        routes = frontier.select(top_n=top_n, **preference)
+    return _json_response(search_result_to_json(routes))
+
+async def handle_routes_batch(request):
+    try:
+        body = await request.json()
+    except ValueError:
+        return _json_response({"error": "тело запроса должно быть JSON-объектом"}, status=400)
+    try:
+        if not isinstance(body, dict):
+            raise ServiceError("тело запроса должно быть JSON-объектом")
+        queries = body.get("queries") or []
+        if not isinstance(queries, list) or len(queries) > SERVICE_MAX_BATCH:
+            raise ServiceError(f"queries — список не более чем из {SERVICE_MAX_BATCH} запросов")
+        queries = [parse_service_batch_query(query, i) for i, query in enumerate(queries)]
+        top_n = parse_service_top_n(body.get("top_n"))
+    except ServiceError as e:
+        return _json_response({"error": str(e)}, status=400)
+    app = request.app
+    city_index = await _service_city_index(app)
+    results = await async_find_routes_batch(queries, city_index=city_index, session=app["session"], top_n=top_n,
+                                            deadline=SERVICE_SEARCH_DEADLINE)
+    return _json_response({"results": [search_result_to_json(routes) for routes in results]})
+
+async def handle_metrics(request):
+    return web.Response(text=render_prometheus(), content_type="text/plain", charset="utf-8")
+
+async def handle_health(request):
+    # Пустой индекс — список станций не загружен, и сервис на любой запрос ответит «маршрутов нет»
+    city_index = await _service_city_index(request.app)
+    if not len(city_index):
+        return _json_response({"status": "no_stations", "cities": 0}, status=503)
+    return _json_response({"status": "ok", "cities": len(city_index)})
+
+async def _service_startup(app):
+    app["session"] = create_client_session()
+    app["city_index"] = await get_city_index_async(app["session"])
+
+async def _service_cleanup(app):
+    await app["session"].close()
+    routes_cache.close()
+
+def create_app():
+    app = web.Application()
+    app.on_startup.append(_service_startup)
+    app.on_cleanup.append(_service_cleanup)
+    app.router.add_get("/api/cities", handle_cities)
+    app.router.add_get("/api/routes", handle_routes)
+    app.router.add_post("/api/routes/batch", handle_routes_batch)
+    app.router.add_get("/metrics", handle_metrics)
+    app.router.add_get("/health", handle_health)
+    return app
+
+def _run_service_worker(host, port, reuse_port, upstream_limits=None, routes_cache_config=None):
+    # Настройки передаются явно: при запуске через spawn или forkserver процесс заново
+    # импортирует модуль и не видит изменений, сделанных в родительском процессе
+    if upstream_limits is not None:
+        configure_upstream_limits(*upstream_limits)
+    if routes_cache_config is not None:
+        # Соединение с SQLite нельзя использовать после fork — каждый процесс открывает своё
+        configure_routes_cache(*routes_cache_config)
+    web.run_app(create_app(), host=host, port=port, reuse_port=reuse_port, access_log=None, print=None)
+
+async def _prepare_stations_snapshot():
+    async with create_client_session() as session:
+        await get_city_index_async(session)
+
+def run_service(host=SERVICE_HOST, port=SERVICE_PORT, workers=SERVICE_WORKERS):
+    if workers <= 1:
+        _run_service_worker(host, port, False)
+        return
+    import multiprocessing
+    import signal
+    # Снимок станций создаётся один раз до запуска обработчиков, которые затем только
+    # отображают его в память. Ограничение частоты запросов к API делится между процессами
+    if STATIONS_SNAPSHOT_PATH:
+        asyncio.run(_prepare_stations_snapshot())
+    upstream_limits = (UPSTREAM_MAX_CONCURRENCY, UPSTREAM_MAX_CONCURRENCY_PER_HOST,
+                       UPSTREAM_MAX_RPS / workers if UPSTREAM_MAX_RPS else None)
+    routes_cache_config = (routes_cache.max_entries, routes_cache.db_path, routes_cache.db_max_entries)
+    processes = [multiprocessing.Process(target=_run_service_worker,
+                                         args=(host, port, True, upstream_limits, routes_cache_config))
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    # SIGTERM главному процессу останавливает и обработчики
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+
 # ================= Основная асинхронная функция =================
 
 async def main_async():
@@ -380,10 +2601,11 @@ async def main_async():
     departure_city = "Ростов-на-Дону"   # Город отправления (обязательный параметр)
     arrival_city1 = "Выборг"   # Первый город прибытия (обязательная точка пересадки)
     arrival_city2 = "Тверь"       # Второй город прибытия
-    async with ClientSession() as session:
+    async with create_client_session() as session:
+        city_index = await get_city_index_async(session)
         if arrival_city2.strip():
             combined_routes = await async_find_combined_routes(
-                session, city_codes_df, candidate_transfer_list,
+                session, city_index, candidate_transfer_list,
                 departure_city, arrival_city1, arrival_city2, departure_date, top_n=1
             )
             if not combined_routes:
@@ -394,7 +2616,7 @@ async def main_async():
             print(format_complex_route(best_route, departure_city, arrival_city1, arrival_city2))
         else:
             best_routes = await async_find_best_routes(
-                session, city_codes_df, candidate_transfer_list,
+                session, city_index, candidate_transfer_list,
                 departure_city, arrival_city1, departure_date, top_n=3
             )
             if not best_routes:
@@ -406,11 +2628,15 @@ async def main_async():
                 print("-" * 40)
 
 if __name__ == "__main__":
-    loop = asyncio.get_event_loop()
-    async def prepare():
-        global city_codes, city_codes_df
-        async with ClientSession() as session:
-            city_codes = await get_city_codes_async(session)
-        city_codes_df = city_codes_to_dataframe(city_codes)
-    loop.run_until_complete(prepare())
-    loop.run_until_complete(main_async())
+    import argparse
+    parser = argparse.ArgumentParser(description="Поиск маршрутов между городами")
+    subparsers = parser.add_subparsers(dest="command")
+    serve_parser = subparsers.add_parser("serve", help="запустить HTTP-сервис поиска")
+    serve_parser.add_argument("--host", default=SERVICE_HOST)
+    serve_parser.add_argument("--port", type=int, default=SERVICE_PORT)
+    serve_parser.add_argument("--workers", type=int, default=SERVICE_WORKERS)
+    args = parser.parse_args()
+    if args.command == "serve":
+        run_service(args.host, args.port, args.workers)
+    else:
+        asyncio.run(main_async())
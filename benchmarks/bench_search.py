@@ -0,0 +1,221 @@
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from aiohttp import ClientError, ClientSession
+
+# Бенчмарк поиска маршрутов на локальной замене API (mock_rasp_server.py).
+# Для каждого сценария и уровня параллелизма выполняется набор поисков с холодным кэшем
+# и выводятся p50/p99 задержки, число запросов к API, пиковая память и пропускная способность.
+# Замена API запускается отдельным процессом, чтобы генерация ответов не попадала
+# в измеряемые задержки и пиковую память.
+#
+#   python benchmarks/bench_search.py --latency-ms 50 --concurrency 1 8 32
+
+ALGORITHM_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "algorythm_3.6.py")
+MOCK_SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_rasp_server.py")
+
+SCENARIOS = {
+    "direct": [
+        ("Москва", "Санкт-Петербург"), ("Москва", "Казань"), ("Екатеринбург", "Новосибирск"),
+        ("Санкт-Петербург", "Выборг"), ("Ростов-на-Дону", "Краснодар"),
+    ],
+    "connecting": [
+        ("Ростов-на-Дону", "Выборг"), ("Таганрог", "Тверь"), ("Псков", "Ярославль"),
+        ("Выборг", "Краснодар"), ("Великий Новгород", "Калининград"),
+    ],
+    "combined": [
+        ("Ростов-на-Дону", "Выборг", "Тверь"), ("Псков", "Москва", "Сочи"),
+    ],
+    "hubs": [
+        ("Москва", "Новосибирск"), ("Санкт-Петербург", "Екатеринбург"), ("Казань", "Краснодар"),
+        ("Новосибирск", "Владивосток"), ("Самара", "Мурманск"), ("Воронеж", "Иркутск"),
+        ("Уфа", "Архангельск"), ("Пермь", "Минеральные Воды"),
+    ],
+}
+
+
+def load_algorithm():
+    # Имя файла содержит точку, поэтому модуль загружается по пути
+    spec = importlib.util.spec_from_file_location("algorythm", ALGORITHM_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class MockServerProcess:
+    # mock_rasp_server.py в отдельном процессе; счётчики запросов читаются по HTTP
+    def __init__(self, latency_ms, jitter_ms, error_rate, not_found_rate, seed):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}"
+        self.process = subprocess.Popen([
+            sys.executable, MOCK_SERVER_PATH, "--port", str(port),
+            "--latency-ms", str(latency_ms), "--jitter-ms", str(jitter_ms),
+            "--error-rate", str(error_rate), "--not-found-rate", str(not_found_rate), "--seed", str(seed),
+        ])
+        self.session = None
+
+    async def start(self, timeout=15.0):
+        self.session = ClientSession()
+        deadline = time.monotonic() + timeout
+        while True:
+            if self.process.poll() is not None:
+                raise RuntimeError("mock_rasp_server.py завершился при запуске")
+            try:
+                await self.stats()
+                return
+            except ClientError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+
+    async def stats(self):
+        async with self.session.get(f"{self.base_url}/_stats") as response:
+            return await response.json()
+
+    async def reset_stats(self):
+        async with self.session.post(f"{self.base_url}/_stats/reset") as response:
+            response.raise_for_status()
+
+    async def stop(self):
+        if self.session is not None:
+            await self.session.close()
+        self.process.terminate()
+        self.process.wait()
+
+
+def percentile(values, q):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    index = min(int(round(q / 100.0 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+async def run_search(alg, session, city_index, query, date):
+    if len(query) == 3:
+        return await alg.async_find_routes(session, city_index, query[0], query[1], date, arrival_city2=query[2])
+    return await alg.async_find_routes(session, city_index, query[0], query[1], date)
+
+
+async def run_scenario(alg, mock, session, city_index, queries, date, concurrency, repeat, warm):
+    if not warm:
+        alg.routes_cache.clear()
+    await mock.reset_stats()
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    found = 0
+    partial = 0
+
+    async def one(query):
+        nonlocal found, partial
+        async with semaphore:
+            started = time.perf_counter()
+            routes = await run_search(alg, session, city_index, query, date)
+            latencies.append((time.perf_counter() - started) * 1000.0)
+            found += bool(routes)
+            partial += getattr(routes, "partial", False)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[one(query) for query in queries * repeat])
+    wall = time.perf_counter() - started
+    stats = await mock.stats()
+    return {
+        "searches": len(latencies),
+        "found": found,
+        "partial": partial,
+        "p50_ms": percentile(latencies, 50),
+        "p99_ms": percentile(latencies, 99),
+        "mean_ms": statistics.fmean(latencies) if latencies else float("nan"),
+        "upstream_calls": stats["search"],
+        "upstream_errors": stats["errors"],
+        "upstream_404": stats["not_found"],
+        "upstream_bytes": stats["bytes"],
+        "throughput_rps": len(latencies) / wall if wall > 0 else float("nan"),
+    }
+
+
+async def run_benchmark(args):
+    alg = load_algorithm()
+    mock = MockServerProcess(args.latency_ms, args.jitter_ms, args.error_rate, args.not_found_rate, args.seed)
+    alg.SEARCH_URL = f"{mock.base_url}/v3.0/search/"
+    alg.STATIONS_URL = f"{mock.base_url}/v3.0/stations_list/"
+    alg.STATIONS_SNAPSHOT_PATH = None
+    # По умолчанию темп запросов не ограничивается: UPSTREAM_MAX_RPS рассчитан на настоящий API
+    # и на локальной замене ограничивал бы пропускную способность, а не поиск
+    alg.configure_upstream_limits(max_rps=args.max_rps or None)
+    results = []
+    try:
+        await mock.start()
+        async with alg.create_client_session() as session:
+            city_index = await alg.get_city_index_async(session)
+            for name in args.scenarios:
+                queries = SCENARIOS[name]
+                for concurrency in args.concurrency:
+                    if args.warm:
+                        await run_scenario(alg, mock, session, city_index, queries, args.date, concurrency, 1, False)
+                    result = await run_scenario(alg, mock, session, city_index, queries, args.date,
+                                                concurrency, args.repeat, args.warm)
+                    # Память измеряется отдельным прогоном: tracemalloc заметно замедляет код.
+                    # Учитываются только выделения клиента — замена API работает в другом процессе
+                    tracemalloc.start()
+                    await run_scenario(alg, mock, session, city_index, queries, args.date,
+                                       concurrency, args.repeat, args.warm)
+                    result["peak_mem_kb"] = tracemalloc.get_traced_memory()[1] / 1024.0
+                    tracemalloc.stop()
+                    result.update({"scenario": name, "concurrency": concurrency})
+                    results.append(result)
+                    print_result(result)
+    finally:
+        await mock.stop()
+    return results
+
+
+def print_header(max_rps):
+    print(f"ограничение запросов к API: {f'{max_rps:g}/с' if max_rps else 'нет'}")
+    print(f"{'scenario':<11}{'conc':>5}{'n':>6}{'found':>6}{'part':>5}{'p50 ms':>10}{'p99 ms':>10}"
+          f"{'calls':>8}{'err':>5}{'404':>5}{'peak KB':>10}{'search/s':>10}")
+
+
+def print_result(result):
+    print(f"{result['scenario']:<11}{result['concurrency']:>5}{result['searches']:>6}{result['found']:>6}{result['partial']:>5}"
+          f"{result['p50_ms']:>10.1f}{result['p99_ms']:>10.1f}{result['upstream_calls']:>8}"
+          f"{result['upstream_errors']:>5}{result['upstream_404']:>5}{result['peak_mem_kb']:>10.0f}"
+          f"{result['throughput_rps']:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк поиска маршрутов на локальной замене API")
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--repeat", type=int, default=4, help="сколько раз повторяется набор запросов сценария")
+    parser.add_argument("--date", default="2025-04-01")
+    parser.add_argument("--warm", action="store_true", help="измерять с заранее прогретым кэшем")
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--jitter-ms", type=float, default=10.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--not-found-rate", type=float, default=0.0)
+    parser.add_argument("--max-rps", type=float, default=0.0,
+                        help="ограничение запросов в секунду (по умолчанию 0 — без ограничения)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="сохранить результаты в JSON-файл")
+    args = parser.parse_args()
+    print_header(args.max_rps)
+    results = asyncio.run(run_benchmark(args))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
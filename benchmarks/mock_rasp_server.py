@@ -0,0 +1,235 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import zlib
+from datetime import datetime, timedelta
+
+from aiohttp import web
+
+# Локальная замена API Яндекс.Расписаний для бенчмарков.
+# Отвечает на /v3.0/stations_list/ и /v3.0/search/ в формате API. Ответы поиска берутся
+# из записанных файлов fixtures/search/<from>_<to>_<date>.json, а если такого файла нет —
+# генерируются детерминированно по координатам городов из fixtures/stations_list.json:
+# города пересадки (transfer_hubs.json) связаны между собой поездами и самолётами,
+# остальные города — поездами и автобусами с ближайшими городами пересадки.
+# Задержка, доля ошибок 500 и доля ответов 404 настраиваются.
+# Счётчики запросов доступны по GET /_stats и сбрасываются POST /_stats/reset, чтобы
+# бенчмарк мог запускать замену API в отдельном процессе.
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+HUBS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "transfer_hubs.json")
+
+# Скорость (км/ч) и число рейсов в сутки для генерируемого расписания
+TRANSPORT_PROFILES = {
+    "train": {"speed": 70.0, "per_day": 4},
+    "plane": {"speed": 600.0, "per_day": 3},
+    "bus": {"speed": 55.0, "per_day": 5},
+}
+LOCAL_LINK_KM = 700.0     # дальность связей обычного города с городами пересадки
+TRAIN_MAX_KM = 3500.0
+PLANE_MIN_KM = 400.0
+BUS_MAX_KM = 700.0
+TIMEZONE = "+03:00"
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371.0 * math.asin(math.sqrt(min(a, 1.0)))
+
+
+class MockRasp:
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, not_found_rate=0.0,
+                 fixtures_dir=FIXTURES_DIR, seed=0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.not_found_rate = not_found_rate
+        self.fixtures_dir = fixtures_dir
+        self._random = random.Random(seed)
+        with open(os.path.join(fixtures_dir, "stations_list.json"), encoding="utf-8") as f:
+            self.stations_list = json.load(f)
+        self.cities = {}
+        for country in self.stations_list.get("countries", []):
+            for region in country.get("regions", []):
+                for settlement in region.get("settlements", []):
+                    code = settlement["codes"]["yandex_code"]
+                    coords = settlement["coords"]
+                    self.cities[code] = (settlement["title"], float(coords["lat"]), float(coords["lon"]))
+        try:
+            with open(HUBS_PATH, encoding="utf-8") as f:
+                hub_names = set(json.load(f))
+        except (OSError, ValueError):
+            hub_names = set()
+        self.hubs = {code for code, (title, _, _) in self.cities.items() if title in hub_names}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {"stations_list": 0, "search": 0, "errors": 0, "not_found": 0, "bytes": 0}
+
+    def _distance(self, from_code, to_code):
+        _, lat1, lon1 = self.cities[from_code]
+        _, lat2, lon2 = self.cities[to_code]
+        return haversine_km(lat1, lon1, lat2, lon2)
+
+    def _nearby_hubs(self, code):
+        hubs = [hub for hub in self.hubs if hub != code and self._distance(code, hub) <= LOCAL_LINK_KM]
+        return hubs or ["c213"]
+
+    def transports(self, from_code, to_code):
+        if from_code == to_code or from_code not in self.cities or to_code not in self.cities:
+            return []
+        distance = self._distance(from_code, to_code)
+        if from_code in self.hubs and to_code in self.hubs:
+            linked = True
+        else:
+            linked = to_code in self._nearby_hubs(from_code) or from_code in self._nearby_hubs(to_code)
+        if not linked:
+            return []
+        transports = []
+        if distance <= TRAIN_MAX_KM:
+            transports.append("train")
+        if distance >= PLANE_MIN_KM and from_code in self.hubs and to_code in self.hubs:
+            transports.append("plane")
+        if distance <= BUS_MAX_KM:
+            transports.append("bus")
+        if not transports:
+            transports.append("plane")
+        return transports
+
+    def generate_segments(self, from_code, to_code, date):
+        day = datetime.strptime(date, "%Y-%m-%d")
+        rnd = random.Random(zlib.crc32(f"{from_code}|{to_code}|{date}".encode()))
+        distance = self._distance(from_code, to_code) if from_code in self.cities and to_code in self.cities else 0.0
+        segments = []
+        for transport in self.transports(from_code, to_code):
+            profile = TRANSPORT_PROFILES[transport]
+            base_minutes = distance / profile["speed"] * 60 + (90 if transport == "plane" else 15)
+            for number in range(profile["per_day"]):
+                departure = day + timedelta(minutes=rnd.randrange(0, 24 * 60, 5))
+                duration = int(base_minutes * rnd.uniform(0.9, 1.25))
+                arrival = departure + timedelta(minutes=duration)
+                price = int(distance * {"train": 2.2, "plane": 5.5, "bus": 1.6}[transport] * rnd.uniform(0.8, 1.4)) + 300
+                segments.append(self._segment(from_code, to_code, transport, number, departure, arrival, price))
+        segments.sort(key=lambda seg: seg["departure"])
+        return segments
+
+    def _segment(self, from_code, to_code, transport, number, departure, arrival, price):
+        from_title, _, _ = self.cities[from_code]
+        to_title, _, _ = self.cities[to_code]
+        thread_number = f"{transport[0].upper()}{zlib.crc32(f'{from_code}{to_code}{number}'.encode()) % 1000:03d}"
+        return {
+            "thread": {
+                "number": thread_number,
+                "title": f"{from_title} — {to_title}",
+                "transport_type": transport,
+                "uid": f"{thread_number}_{from_code}_{to_code}_{departure:%Y%m%d%H%M}",
+                "carrier": {"title": "Mock"},
+            },
+            "from": {"code": f"s{from_code[1:]}", "title": from_title, "station_type": "station"},
+            "to": {"code": f"s{to_code[1:]}", "title": to_title, "station_type": "station"},
+            "departure": departure.isoformat() + TIMEZONE,
+            "arrival": arrival.isoformat() + TIMEZONE,
+            "duration": (arrival - departure).total_seconds(),
+            "has_transfers": False,
+            "tickets_info": {"et_marker": False, "places": [
+                {"currency": "RUB", "price": {"whole": price, "cents": 0}, "name": None}
+            ]},
+        }
+
+    def _recorded(self, from_code, to_code, date):
+        path = os.path.join(self.fixtures_dir, "search", f"{from_code}_{to_code}_{date}.json")
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+
+    async def _delay(self):
+        delay = self.latency_ms + (self._random.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0.0)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000.0)
+
+    def _json(self, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.stats["bytes"] += len(body)
+        return web.Response(body=body, content_type="application/json", charset="utf-8")
+
+    async def handle_stations_list(self, request):
+        self.stats["stations_list"] += 1
+        await self._delay()
+        return self._json(self.stations_list)
+
+    async def handle_search(self, request):
+        self.stats["search"] += 1
+        await self._delay()
+        roll = self._random.random()
+        if roll < self.error_rate:
+            self.stats["errors"] += 1
+            return web.json_response({"error": {"text": "mock error"}}, status=500)
+        if roll < self.error_rate + self.not_found_rate:
+            self.stats["not_found"] += 1
+            return web.json_response({"error": {"text": "not found"}}, status=404)
+        query = request.query
+        from_code, to_code, date = query.get("from", ""), query.get("to", ""), query.get("date", "")[:10]
+        payload = self._recorded(from_code, to_code, date)
+        if payload is None:
+            segments = self.generate_segments(from_code, to_code, date)
+            payload = {
+                "search": {"date": date, "from": {"code": from_code}, "to": {"code": to_code}},
+                "segments": segments,
+                "interval_segments": [],
+                "pagination": {"total": len(segments), "limit": 100, "offset": 0},
+            }
+        min_dep_time = query.get("min_dep_time")
+        if min_dep_time:
+            threshold = datetime.fromisoformat(min_dep_time)
+            payload = dict(payload, segments=[
+                seg for seg in payload.get("segments", [])
+                if datetime.fromisoformat(seg["departure"]).replace(tzinfo=None) >= threshold
+            ])
+        return self._json(payload)
+
+    async def handle_stats(self, request):
+        return web.json_response(self.stats)
+
+    async def handle_stats_reset(self, request):
+        self.reset_stats()
+        return web.json_response(self.stats)
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_get("/v3.0/stations_list/", self.handle_stations_list)
+        app.router.add_get("/v3.0/search/", self.handle_search)
+        app.router.add_get("/_stats", self.handle_stats)
+        app.router.add_post("/_stats/reset", self.handle_stats_reset)
+        return app
+
+
+async def start_mock_server(mock, host="127.0.0.1", port=0):
+    runner = web.AppRunner(mock.make_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://{host}:{port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальная замена API Яндекс.Расписаний")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--not-found-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    mock = MockRasp(args.latency_ms, args.jitter_ms, args.error_rate, args.not_found_rate, seed=args.seed)
+    web.run_app(mock.make_app(), host=args.host, port=args.port, access_log=None, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import argparse
+import asyncio
+import json
+import os
+
+from aiohttp import ClientSession
+
+from bench_search import SCENARIOS, load_algorithm
+from mock_rasp_server import FIXTURES_DIR
+
+# Записывает ответы настоящего API /search/ для сценариев бенчмарка в fixtures/search/,
+# чтобы mock_rasp_server.py воспроизводил их вместо сгенерированного расписания.
+# Записываются прямые запросы между городами сценариев и запросы через города пересадки.
+#
+#   python benchmarks/record_fixtures.py --date 2025-04-01 --days 2
+
+
+async def record(args):
+    alg = load_algorithm()
+    out_dir = os.path.join(FIXTURES_DIR, "search")
+    os.makedirs(out_dir, exist_ok=True)
+    async with ClientSession() as session:
+        city_index = await alg.get_city_index_async(session)
+        pairs = set()
+        for name in args.scenarios:
+            for query in SCENARIOS[name]:
+                pairs.update(zip(query, query[1:]))
+        keys = set()
+        for departure_city, arrival_city in pairs:
+            dep_code = city_index.get_code(departure_city)
+            arr_code = city_index.get_code(arrival_city)
+            if not dep_code or not arr_code:
+                continue
+            hubs = [city_index.get_code(city)
+                    for city in alg.select_transfer_hubs(city_index, dep_code, arr_code, alg.candidate_transfer_list)]
+            for day in range(args.days):
+                date = (alg.datetime.strptime(args.date, "%Y-%m-%d") + alg.timedelta(days=day)).strftime("%Y-%m-%d")
+                keys.add((dep_code, arr_code, date))
+                for hub in hubs:
+                    keys.add((dep_code, hub, date))
+                    keys.add((hub, arr_code, date))
+        recorded, failed = 0, []
+        for from_code, to_code, date in sorted(keys):
+            params = {"apikey": alg.API_KEY, "format": "json", "from": from_code, "to": to_code,
+                      "date": date, "lang": "ru_RU"}
+            # Неудачный запрос не записывается: пустой файл выглядел бы как «рейсов нет»
+            data, ok = await alg._fetch_json(session, alg.SEARCH_URL, params)
+            if not ok:
+                failed.append((from_code, to_code, date))
+                continue
+            with open(os.path.join(out_dir, f"{from_code}_{to_code}_{date}.json"), "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            recorded += 1
+        print(f"Записано ответов: {recorded} из {len(keys)}")
+        for from_code, to_code, date in failed:
+            print(f"  не удалось получить: {from_code} -> {to_code}, {date}")
+    return not failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Запись ответов API для бенчмарка")
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument("--date", required=True)
+    parser.add_argument("--days", type=int, default=2)
+    if not asyncio.run(record(parser.parse_args())):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import importlib.util
+import os
+import sqlite3
+import time
+
+import pytest
+
+ALGORITHM_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "algorythm_3.6.py")
+
+
+@pytest.fixture(scope="module")
+def alg():
+    # Имя файла содержит точку, поэтому модуль загружается по пути
+    spec = importlib.util.spec_from_file_location("algorythm", ALGORITHM_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+KEY = ("c213", "c2", "2025-04-01", "")
+
+
+def make_segment(alg):
+    return alg.Segment(600, 840, 0, "001А", "001A_0", "s1", "s2", "{}", 1500.0)
+
+
+def test_routes_survive_reopen(alg, tmp_path):
+    db_path = str(tmp_path / "routes.sqlite")
+    cache = alg.RoutesCache(db_path=db_path)
+    cache.set(KEY, [make_segment(alg)], 60)
+    cache.close()
+    reopened = alg.RoutesCache(db_path=db_path)
+    try:
+        [segment] = reopened.get(KEY)
+        assert segment.to_row() == make_segment(alg).to_row()
+    finally:
+        reopened.close()
+
+
+def test_locked_database_falls_back_to_memory(alg, tmp_path):
+    # Другой процесс держит блокировку записи: кэш не должен ни падать, ни ждать busy timeout
+    db_path = str(tmp_path / "routes.sqlite")
+    cache = alg.RoutesCache(db_path=db_path)
+    other = sqlite3.connect(db_path)
+    try:
+        other.execute("BEGIN EXCLUSIVE")
+        started = time.monotonic()
+        cache.set(KEY, [make_segment(alg)], 60)
+        assert cache.get(KEY)[0].number == "001А"
+        assert cache.get(("c213", "c43", "2025-04-01", "")) is None
+        assert time.monotonic() - started < 1.0
+    finally:
+        other.rollback()
+        other.close()
+        cache.close()
@@ -0,0 +1,81 @@
+import importlib.util
+import json
+import os
+
+import pytest
+
+ALGORITHM_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "algorythm_3.6.py")
+
+
+@pytest.fixture(scope="module")
+def alg():
+    # Имя файла содержит точку, поэтому модуль загружается по пути
+    spec = importlib.util.spec_from_file_location("algorythm", ALGORITHM_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_segment(number, title="Москва — Казань"):
+    return {
+        "departure": "2025-04-01T10:00:00+03:00",
+        "arrival": "2025-04-01T22:30:00+03:00",
+        "thread": {"number": number, "title": title, "transport_type": "train", "uid": f"{number}_0",
+                   "carrier": {"title": "ФПК", "phone": "8 800"}, "days": "ежедневно"},
+        "from": {"code": "s2000001", "title": "Москва"},
+        "to": {"code": "s9623131", "title": "Казань"},
+        "stops": "",
+        "tickets_info": {"places": [{"currency": "RUB", "price": {"whole": 2500, "cents": 50}, "name": "купе"}]},
+    }
+
+
+def items(alg, text, key="segments"):
+    return list(alg.iter_json_array_items(text, key))
+
+
+def test_items_match_json_loads(alg):
+    payload = {"search": {"date": "2025-04-01"}, "segments": [make_segment("001А"), make_segment("003Г")],
+               "pagination": {"total": 2}}
+    text = json.dumps(payload, ensure_ascii=False, indent=1)
+    assert items(alg, text) == payload["segments"]
+
+
+def test_nested_segments_key_is_ignored(alg):
+    # Поле segments внутри вложенного объекта — не массив ответа
+    text = '{"search": {"segments": [1, 2]}, "interval_segments": [3], "segments": [{"a": {"segments": [4]}}]}'
+    assert items(alg, text) == [{"a": {"segments": [4]}}]
+
+
+def test_missing_null_and_empty_segments(alg):
+    assert items(alg, '{"search": {}, "pagination": {"total": 0}}') == []
+    assert items(alg, '{"segments": null}') == []
+    assert items(alg, '{"segments": []}') == []
+    assert items(alg, ' { } ') == []
+
+
+def test_strings_with_brackets(alg):
+    # Скобки и кавычки внутри строк не завершают массив и объект
+    segment = make_segment("]}", title='Поезд "]}" — ], }, [{')
+    text = json.dumps({"note": "]}", "segments": [segment, "],"]}, ensure_ascii=False)
+    assert items(alg, text) == [segment, "],"]
+    assert [s.number for s in alg.parse_search_segments(text)] == ["]}"]
+
+
+@pytest.mark.parametrize("text", [
+    "", "[]", '{"segments": [', '{"segments": [{"a": 1}', '{"segments": [1 2]}', '{"segments" [1]}',
+    '{"segments": [1]', '{"a": 1 "segments": []}',
+])
+def test_malformed_json_raises_value_error(alg, text):
+    with pytest.raises(ValueError):
+        items(alg, text)
+
+
+def test_segment_keeps_only_route_fields(alg):
+    [segment] = alg.parse_search_segments(json.dumps({"segments": [make_segment("001А")]}, ensure_ascii=False))
+    raw = segment.raw
+    assert segment.price == 2500.5
+    assert raw["thread"] == {"number": "001А", "title": "Москва — Казань", "transport_type": "train",
+                             "uid": "001А_0", "carrier": {"title": "ФПК"}}
+    assert raw["from"] == {"code": "s2000001", "title": "Москва"}
+    assert "stops" not in raw
+    assert alg.parse_ticket_price(raw) == 2500.5
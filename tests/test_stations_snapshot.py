@@ -0,0 +1,115 @@
+import asyncio
+import importlib.util
+import os
+
+import pytest
+
+ALGORITHM_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "algorythm_3.6.py")
+
+
+@pytest.fixture
+def alg():
+    # Модуль загружается заново для каждого теста: индекс и снимок хранятся в глобальных переменных
+    spec = importlib.util.spec_from_file_location("algorythm", ALGORITHM_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+STATIONS = {"countries": [{"regions": [{"settlements": [
+    {"title": "Москва", "codes": {"yandex_code": "c213"}, "coords": {"lat": 55.75, "lon": 37.62}},
+    {"title": "Казань", "codes": {"yandex_code": "c43"}, "coords": {"lat": 55.79, "lon": 49.12}},
+]}]}]}
+
+
+def test_empty_index_is_not_cached_after_failed_fetch(alg, tmp_path, monkeypatch):
+    # Список станций недоступен при запуске, затем API восстанавливается
+    responses = [(None, None, {}), (200, STATIONS, {"ETag": "v1"})]
+    calls = []
+
+    async def fetch_stations(session, etag=None, last_modified=None):
+        calls.append(etag)
+        return responses[min(len(calls), len(responses)) - 1]
+
+    monkeypatch.setattr(alg, "_fetch_stations_conditional", fetch_stations)
+    monkeypatch.setattr(alg, "STATIONS_RETRY_INTERVAL", 0)
+    path = str(tmp_path / "stations_snapshot.bin")
+
+    async def load_twice():
+        first = await alg.get_city_index_async(None, path)
+        second = await alg.get_city_index_async(None, path)
+        return first, second
+
+    first, second = asyncio.run(load_twice())
+    assert len(first) == 0
+    assert len(calls) == 2
+    assert second.get_code("Казань") == "c43"
+    assert os.path.exists(path)
+
+
+def make_index(alg):
+    return alg.build_city_index([
+        {"Город": "Москва", "Yandex-код": "c213", "coords": (55.75, 37.62)},
+        {"Город": "Казань", "Yandex-код": "c43", "coords": (55.79, 49.12)},
+        {"Город": "Тверь", "Yandex-код": "c14"},
+    ])
+
+
+def test_snapshot_round_trip(alg, tmp_path):
+    path = str(tmp_path / "stations_snapshot.bin")
+    index = make_index(alg)
+    alg.write_stations_snapshot(path, index, etag="v1", last_modified="Tue, 01 Apr 2025 00:00:00 GMT")
+    snapshot = alg.load_stations_snapshot(path)
+    assert snapshot.index.names == index.names
+    assert snapshot.index.codes == index.codes
+    assert snapshot.index.keys == index.keys
+    assert snapshot.index.get_code("казань") == "c43"
+    assert snapshot.index.get_coords("c213") == pytest.approx((55.75, 37.62), abs=1e-4)
+    assert snapshot.index.get_coords("c14") is None
+    assert [city["Город"] for city in snapshot.index.suggest("т")] == ["Тверь"]
+    assert snapshot.meta["etag"] == "v1"
+    assert snapshot.age() < 60
+
+
+def test_empty_snapshot_round_trip(alg, tmp_path):
+    path = str(tmp_path / "stations_snapshot.bin")
+    alg.write_stations_snapshot(path, alg.build_city_index([]))
+    assert len(alg.load_stations_snapshot(path).index) == 0
+
+
+def test_truncated_snapshot_is_rejected(alg, tmp_path):
+    # Обрезка в любом месте до конца данных — ValueError, а не частично прочитанный индекс;
+    # нули в конце файла — только выравнивание последней секции
+    path = str(tmp_path / "stations_snapshot.bin")
+    alg.write_stations_snapshot(path, make_index(alg))
+    with open(path, "rb") as f:
+        data = f.read()
+    truncated = str(tmp_path / "truncated.bin")
+    for size in range(len(data.rstrip(b"\0"))):
+        with open(truncated, "wb") as f:
+            f.write(data[:size])
+        with pytest.raises(ValueError):
+            alg.load_stations_snapshot(truncated)
+
+
+def test_bad_magic_is_rejected(alg, tmp_path):
+    path = str(tmp_path / "stations_snapshot.bin")
+    alg.write_stations_snapshot(path, make_index(alg))
+    with open(path, "r+b") as f:
+        f.write(b"NOTSNAP!")
+    with pytest.raises(ValueError, match="не является снимком"):
+        alg.load_stations_snapshot(path)
+
+
+def test_truncated_snapshot_is_rebuilt_on_startup(alg, tmp_path, monkeypatch):
+    async def fetch_stations(session, etag=None, last_modified=None):
+        return 200, STATIONS, {}
+
+    monkeypatch.setattr(alg, "_fetch_stations_conditional", fetch_stations)
+    path = str(tmp_path / "stations_snapshot.bin")
+    alg.write_stations_snapshot(path, make_index(alg))
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 20)
+    index = asyncio.run(alg.load_city_index(None, path))
+    assert index.codes == ("c43", "c213")
+    assert len(alg.load_stations_snapshot(path).index) == 2
@@ -0,0 +1,119 @@
+import importlib.util
+import os
+import random
+
+import pytest
+
+ALGORITHM_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "algorythm_3.6.py")
+
+
+@pytest.fixture(scope="module")
+def alg():
+    # Имя файла содержит точку, поэтому модуль загружается по пути
+    spec = importlib.util.spec_from_file_location("algorythm", ALGORITHM_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+DAY = "2025-04-01"
+
+
+def minutes(alg, day_offset, hh, mm=0):
+    return alg.datetime_to_minutes(alg.datetime(2025, 4, 1 + day_offset, hh, mm))
+
+
+def make_connection(alg, from_code, to_code, departure, arrival, transport=0, number=None):
+    number = number or f"{from_code}{to_code}{departure}"
+    segment = alg.Segment(departure, arrival, transport, number, number, from_code, to_code, "{}")
+    return from_code, to_code, segment
+
+
+def brute_force_front(alg, connections, origin, target, max_transfers):
+    # Перебор всех маршрутов без повторных городов
+    day_start = minutes(alg, 0, 0)
+    journeys = []
+
+    def extend(path, visited):
+        last = path[-1]
+        if last[1] == target:
+            journeys.append((path[-1][2].arrival_min - path[0][2].departure_min, len(path)))
+            return
+        if len(path) > max_transfers:
+            return
+        for conn in connections:
+            from_code, to_code, segment = conn
+            if from_code != last[1] or to_code in visited:
+                continue
+            wait = alg.REQUIRED_WAIT_MINUTES[last[2].transport, segment.transport]
+            if segment.departure_min >= last[2].arrival_min + wait:
+                extend(path + [conn], visited | {to_code})
+
+    for conn in connections:
+        from_code, to_code, segment = conn
+        if from_code == origin and day_start <= segment.departure_min < day_start + 24 * 60:
+            extend([conn], {origin, to_code})
+    journeys.sort(key=lambda x: (x[1], x[0]))
+    front = []
+    for duration, legs in journeys:
+        if not front or (duration < front[-1][0] and legs > front[-1][1]):
+            front.append((duration, legs))
+    return front
+
+
+def check_journey(alg, graph, origin, target, duration, legs, conns):
+    assert len(conns) == legs
+    segments = [graph.segments[conn] for conn in conns]
+    stops = [graph.stops[graph.from_idx[conns[0]]]] + [graph.stops[graph.to_idx[conn]] for conn in conns]
+    assert stops[0] == origin and stops[-1] == target
+    assert len(set(stops)) == len(stops)
+    for conn1, conn2 in zip(conns, conns[1:]):
+        assert graph.to_idx[conn1] == graph.from_idx[conn2]
+    for seg1, seg2 in zip(segments, segments[1:]):
+        assert seg2.departure_min >= seg1.arrival_min + alg.REQUIRED_WAIT_MINUTES[seg1.transport, seg2.transport]
+    assert segments[-1].arrival_min - segments[0].departure_min == duration
+
+
+def test_journey_does_not_return_to_origin(alg):
+    connections = [
+        make_connection(alg, "A", "B", minutes(alg, 0, 8), minutes(alg, 0, 9)),
+        make_connection(alg, "B", "A", minutes(alg, 0, 9, 30), minutes(alg, 0, 10, 30)),
+        make_connection(alg, "A", "C", minutes(alg, 1, 8), minutes(alg, 1, 9)),
+    ]
+    graph = alg.TimetableGraph(connections)
+    assert graph.find_journeys("A", "C", DAY) == []
+
+
+def test_journey_does_not_revisit_transfer_city(alg):
+    connections = [
+        make_connection(alg, "A", "B", minutes(alg, 0, 8), minutes(alg, 0, 9), transport=1),
+        make_connection(alg, "B", "D", minutes(alg, 0, 10), minutes(alg, 0, 11), transport=2),
+        make_connection(alg, "D", "B", minutes(alg, 0, 12), minutes(alg, 0, 13), transport=0),
+        make_connection(alg, "B", "C", minutes(alg, 0, 13, 30), minutes(alg, 0, 14), transport=0),
+    ]
+    graph = alg.TimetableGraph(connections)
+    front = graph.find_journeys("A", "C", DAY)
+    assert [(duration, legs) for duration, legs, _ in front] == [(360, 2)]
+    for duration, legs, conns in front:
+        check_journey(alg, graph, "A", "C", duration, legs, conns)
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_find_journeys_matches_brute_force(alg, seed):
+    rnd = random.Random(seed)
+    stops = [f"c{i}" for i in range(rnd.randint(3, 7))]
+    connections = []
+    for number in range(rnd.randint(5, 60)):
+        from_code, to_code = rnd.sample(stops, 2)
+        departure = minutes(alg, 0, 0) + rnd.randrange(0, 2 * 24 * 60, 5)
+        arrival = departure + rnd.randrange(30, 600, 5)
+        connections.append(make_connection(alg, from_code, to_code, departure, arrival,
+                                           rnd.randrange(alg.TRANSPORT_OTHER + 1), f"n{number}"))
+    graph = alg.TimetableGraph(connections)
+    max_transfers = rnd.randint(0, 3)
+    origin, target = rnd.sample(stops, 2)
+    front = graph.find_journeys(origin, target, DAY, max_transfers)
+    assert [(duration, legs) for duration, legs, _ in front] == \
+        brute_force_front(alg, connections, origin, target, max_transfers)
+    for duration, legs, conns in front:
+        check_journey(alg, graph, origin, target, duration, legs, conns)
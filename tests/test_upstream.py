@@ -0,0 +1,74 @@
+import asyncio
+import importlib.util
+import os
+
+import pytest
+from aiohttp import ClientSession, web
+
+ALGORITHM_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "algorythm_3.6.py")
+
+
+@pytest.fixture(scope="module")
+def alg():
+    # Имя файла содержит точку, поэтому модуль загружается по пути
+    spec = importlib.util.spec_from_file_location("algorythm", ALGORITHM_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+async def start_slow_server(delay):
+    async def handle_search(request):
+        await asyncio.sleep(delay)
+        return web.json_response({"segments": []})
+
+    app = web.Application()
+    app.router.add_get("/v3.0/search/", handle_search)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/v3.0/search/"
+
+
+def test_cancelled_fetch_stays_cancelled(alg, monkeypatch):
+    # Отменённый запрос к API завершает задачу отменой, а не пустым ответом
+    monkeypatch.setattr(alg, "METRICS_ENABLED", True)
+
+    async def run():
+        runner, url = await start_slow_server(1)
+        try:
+            async with ClientSession() as session:
+                task = asyncio.ensure_future(alg._fetch_text_once(session, url, {}))
+                await asyncio.sleep(0.1)
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                return task.cancelled()
+        finally:
+            await runner.cleanup()
+
+    assert asyncio.run(run())
+    assert 'outcome="cancelled"' in alg.render_prometheus()
+
+
+def test_unneeded_search_is_cancelled(alg, monkeypatch):
+    # Единственный ожидающий отменён — общий запрос в API отменяется, а не завершается пустым списком
+    async def run():
+        runner, url = await start_slow_server(1)
+        monkeypatch.setattr(alg, "SEARCH_URL", url)
+        try:
+            async with ClientSession() as session:
+                key = alg.make_routes_cache_key("c213", "c43", "2025-04-01")
+                search = asyncio.ensure_future(alg.async_search_segments(session, *key[:3]))
+                await asyncio.sleep(0.1)
+                [shared, _] = alg.get_upstream_limiter().inflight[key]
+                search.cancel()
+                await asyncio.gather(search, shared, return_exceptions=True)
+                return shared.cancelled(), alg.routes_cache.get(key)
+        finally:
+            await runner.cleanup()
+
+    cancelled, cached = asyncio.run(run())
+    assert cancelled
+    assert cached is None